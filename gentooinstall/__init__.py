@@ -1,59 +1,224 @@
 # pylint: disable=missing-module-docstring
 import argparse
 import os
+from typing import List, Optional
 
-from rich.traceback import install
+__version__ = "0.1.0"
 
-from .lib.installer import *
-from .lib.storage import storage
 
-__version__ = "0.1.0"
+def build_parser() -> argparse.ArgumentParser:
+    """
+    Returns the parser of the command line options.
+    """
+    # Initialize argument parser
+    parser = argparse.ArgumentParser(
+        prog="gentooinstall",
+        description=(
+            "The program aimed to help both beginners "
+            "and experienced users install gentoo."
+        ),
+    )
+
+    # --config option
+    parser.add_argument(
+        "--config",
+        action="store",
+        help="Optional JSON file or url that can be passed in to do an UNATTENDED install.",
+    )
+
+    # no-ntp option
+    parser.add_argument(
+        "--no-ntp",
+        action="store_true",
+        help="Disables using NTP to sync the time. Use this if you have set the time manually.",
+    )
+
+    # no-optimal-mirror-api
+    parser.add_argument(
+        "--no-optimal-mirror",
+        action="store_true",
+        help="Disables measuring the mirrors to find the fastest one.",
+    )
+
+    # stream-stage3
+    parser.add_argument(
+        "--stream-stage3",
+        action="store_true",
+        help="Extracts the stage3 tarball while it downloads instead of saving it to disk first.",
+    )
+
+    # stage3-cache
+    parser.add_argument(
+        "--stage3-cache",
+        action="store",
+        metavar="DIR",
+        help="Directory where verified stage3 tarballs are kept and reused by later installs.",
+    )
+
+    # stage3-cache-size
+    parser.add_argument(
+        "--stage3-cache-size",
+        action="store",
+        type=int,
+        default=4,
+        metavar="GIB",
+        help="Maximum size of the stage3 cache in gigabytes. Defaults to 4.",
+    )
+
+    # profile
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Captures cProfile data for each install phase next to the timing report.",
+    )
+
+    # format-jobs
+    parser.add_argument(
+        "--format-jobs",
+        action="store",
+        type=int,
+        default=4,
+        metavar="N",
+        help="How many partitions are formatted at once. Defaults to 4, use 1 for spinning disks.",
+    )
+
+    # fast-format
+    parser.add_argument(
+        "--fast-format",
+        action="store_true",
+        help="Discards SSDs before partitioning and picks mkfs options that format faster.",
+    )
+
+    # btrfs-compression
+    parser.add_argument(
+        "--btrfs-compression",
+        action="store",
+        type=int,
+        default=3,
+        metavar="LEVEL",
+        help="zstd level btrfs partitions are mounted with, 0 disables it. Defaults to 3.",
+    )
+
+    # no-portage-tmpfs
+    parser.add_argument(
+        "--no-portage-tmpfs",
+        action="store_true",
+        help="Disables building packages in memory on the installed system.",
+    )
 
-# Install rich as traceback handler
-install()
-
-# Initialize argument parser
-parser = argparse.ArgumentParser(
-    prog="gentooinstall",
-    description="The program aimed to help both beginners and experienced users install gentoo.",
-)
-
-# --config option
-parser.add_argument(
-    "--config",
-    action="store",
-    help="Optional JSON file or url that can be passed in to do an UNATTENDED install.",
-)
-
-# no-ntp option
-parser.add_argument(
-    "--no-ntp",
-    action="store_true",
-    help="Disables using NTP to sync the time. Use this if you have set the time manually.",
-)
-
-# no-optimal-mirror-api
-parser.add_argument(
-    "--no-optimal-mirror",
-    action="store_true",
-    help="Disables using 3rd party api to find optimal mirror.",
-)
-
-# If --config is specified, then we will overwrite values within the inital storage object
-
-# Keep the args in our storage
-arguments = parser.parse_args()
-storage.args["no_ntp"] = arguments.no_ntp
-storage.args["no_optimal_mirror"] = arguments.no_optimal_mirror
-
-
-def run_as_module():
+    # march
+    parser.add_argument(
+        "--march",
+        action="store",
+        default="native",
+        help="The -march packages are compiled with. Defaults to native (this cpu).",
+    )
+
+    # binhost
+    parser.add_argument(
+        "--binhost",
+        action="store",
+        nargs="?",
+        const="official",
+        metavar="URL",
+        help="Installs binary packages when available, from URL or the official binhost.",
+    )
+
+    # binpkg-cache
+    parser.add_argument(
+        "--binpkg-cache",
+        action="store",
+        metavar="DIR",
+        help="Directory where binary packages are kept and reused by later installs.",
+    )
+
+    # distfiles-cache
+    parser.add_argument(
+        "--distfiles-cache",
+        action="store",
+        metavar="DIR",
+        help="Directory where downloaded sources are kept and reused by later installs.",
+    )
+
+    # ccache
+    parser.add_argument(
+        "--ccache",
+        action="store",
+        metavar="DIR",
+        help="Directory of a compiler cache shared by later installs.",
+    )
+
+    # ccache-size
+    parser.add_argument(
+        "--ccache-size",
+        action="store",
+        type=int,
+        default=10,
+        metavar="GIB",
+        help="Maximum size of the compiler cache in gigabytes. Defaults to 10.",
+    )
+
+    # zram-swap
+    parser.add_argument(
+        "--zram-swap",
+        action="store",
+        choices=["off", "front", "instead"],
+        default="off",
+        help="Swaps to compressed memory in front of the swap partition, or instead of it.",
+    )
+
+    # zram-algorithm
+    parser.add_argument(
+        "--zram-algorithm",
+        action="store",
+        default="zstd",
+        help="Compression algorithm of the zram swap. Defaults to zstd.",
+    )
+    return parser
+
+
+def run_as_module(argv: Optional[List[str]] = None):
     """
     Running this program as a module, so this and __main__ will act as entry point.
+    Nothing but the options is looked at until they are parsed,
+    so --help and bad options don't pay for loading the installer.
+    - argv: optional options to use instead of sys.argv
     """
+    # If --config is specified, then we will overwrite values within the inital storage object
+    arguments = build_parser().parse_args(argv)
+
+    # pylint: disable=import-outside-toplevel
+    from .lib.storage import storage
+
+    # Keep the args in our storage
+    storage.args["no_ntp"] = arguments.no_ntp
+    storage.args["no_optimal_mirror"] = arguments.no_optimal_mirror
+    storage.args["stream_stage3"] = arguments.stream_stage3
+    storage.args["stage3_cache"] = arguments.stage3_cache
+    storage.args["stage3_cache_size"] = arguments.stage3_cache_size
+    storage.args["profile"] = arguments.profile
+    storage.args["format_jobs"] = max(arguments.format_jobs, 1)
+    storage.args["fast_format"] = arguments.fast_format
+    storage.args["btrfs_compression"] = arguments.btrfs_compression
+    storage.args["no_portage_tmpfs"] = arguments.no_portage_tmpfs
+    storage.args["march"] = arguments.march
+    storage.args["binhost"] = arguments.binhost
+    storage.args["binpkg_cache"] = arguments.binpkg_cache
+    storage.args["distfiles_cache"] = arguments.distfiles_cache
+    storage.args["ccache"] = arguments.ccache
+    storage.args["ccache_size"] = arguments.ccache_size
+    storage.args["zram_swap"] = arguments.zram_swap
+    storage.args["zram_algorithm"] = arguments.zram_algorithm
 
     # Before running the app check if we have root permissions.
     if os.geteuid() != 0:
         raise PermissionError("You need to be root to run this script")
 
+    from rich.traceback import install
+
+    from .lib.installer import execute
+
+    # Install rich as traceback handler
+    install()
+
     execute()
@@ -0,0 +1,136 @@
+"""
+This module houses the content-addressed cache of stage3 tarballs.
+"""
+import contextlib
+import hashlib
+import os
+from typing import Callable, List, Optional, Sequence
+
+import requests
+
+from . import download
+from .exceptions import DigestMismatchError, NetworkError
+from .network import session
+
+# Default upper bound (in bytes) of the cache size
+DEFAULT_MAX_SIZE = 4 * 1024 * 1024 * 1024
+
+
+def published_digest(url: str, digests_urls: Sequence[str] = ()) -> str:
+    """
+    Returns the SHA512 of the file at url, as published in its .DIGESTS file.
+    - digests_urls: optional urls of the .DIGESTS file, tried in turn,
+      defaults to next to url
+    """
+    error: Optional[requests.RequestException] = None
+    for digests_url in digests_urls or [f"{url}.DIGESTS"]:
+        try:
+            resp = session.get(digests_url)
+            resp.raise_for_status()
+            break
+        except requests.RequestException as exception:
+            error = exception
+    else:
+        raise NetworkError(f"Failed to get the digests of: {url}") from error
+
+    # The file is made of "# <ALGORITHM> HASH" headers followed by "<hash>  <filename>" lines
+    filename = url.rsplit("/", 1)[-1]
+    algorithm = ""
+    for line in resp.text.splitlines():
+        if line.startswith("#"):
+            algorithm = line.lstrip("# ").split(" ")[0].upper()
+        elif algorithm == "SHA512":
+            parts = line.split()
+            if len(parts) == 2 and parts[1] == filename:
+                return parts[0].lower()
+    raise NetworkError(f"No SHA512 digest published for: {url}")
+
+
+class Stage3Cache:
+    """
+    Directory of stage3 tarballs named after their SHA512.
+    Tarballs are verified while they are written, and the least recently used ones
+    are removed once the directory grows past max_size.
+    """
+
+    def __init__(self, directory: str, max_size: int = DEFAULT_MAX_SIZE) -> None:
+        """
+        - directory: where the tarballs are kept
+        - max_size: upper bound (in bytes) of the total size of the tarballs
+        """
+        self.directory = directory
+        self.max_size = max_size
+
+    def path(self, digest: str) -> str:
+        """
+        Returns where the tarball with the given SHA512 is (or would be) kept.
+        """
+        return os.path.join(self.directory, f"{digest}.tar.xz")
+
+    def lookup(self, digest: str) -> Optional[str]:
+        """
+        Returns the path of the cached tarball, or None if it isn't cached.
+        """
+        path = self.path(digest)
+        if not os.path.isfile(path):
+            return None
+        # The modification time keeps track of when an entry was last used
+        os.utime(path)
+        return path
+
+    def fill(
+        self,
+        urls: List[str],
+        digest: str,
+        advance: Optional[Callable[[int], None]] = None,
+        on_length: Optional[Callable[[int], None]] = None,
+    ) -> str:
+        """
+        Downloads the tarball into the cache, hashing each chunk as it is written,
+        and returns the path of the cached tarball.
+        Raises DigestMismatchError (and keeps nothing) if the SHA512 doesn't match digest.
+        - urls: mirrors of the tarball, the first one is used until it fails
+        - advance, on_length: optional callbacks, see download.stream()
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(digest)
+        temp_path = f"{path}.part"
+        sha512 = hashlib.sha512()
+        try:
+            with open(temp_path, "wb") as file:
+                for chunk in download.stream(urls[0], advance, on_length, urls[1:]):
+                    sha512.update(chunk)
+                    file.write(chunk)
+            if sha512.hexdigest() != digest.lower():
+                raise DigestMismatchError(
+                    f"{urls[0]} has SHA512 {sha512.hexdigest()}, expected {digest}"
+                )
+        except BaseException:
+            # The file may never have been created, which mustn't hide the real error
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(temp_path)
+            raise
+        os.replace(temp_path, path)
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        """
+        Removes the least recently used tarballs until the cache fits in max_size.
+        - keep: optional path that is never removed
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".tar.xz") and path != keep:
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        if keep is not None:
+            total += os.path.getsize(keep)
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            os.remove(path)
+            total -= size
@@ -0,0 +1,190 @@
+"""
+This module runs commands inside the new system,
+through one shell that lives for as long as the session.
+"""
+import atexit
+import contextlib
+import os
+import shutil
+import signal
+import subprocess
+import time
+import uuid
+from typing import Callable, List, Optional
+
+from .exceptions import CommandError
+from .general import run_command
+from .profiling import profiler
+
+# Seconds the shell gets to exit by itself before it is killed
+EXIT_TIMEOUT = 5
+# Environment of the shell, nothing from the live system leaks in
+ENVIRONMENT = {
+    "HOME": "/root",
+    "LANG": "C.UTF-8",
+    "PATH": "/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin",
+    "TERM": os.environ.get("TERM", "linux"),
+}
+
+
+class ChrootSession:
+    """
+    Sets up the bind mounts (and resolv.conf) a chroot needs once,
+    and keeps a shell inside of it which runs every command.
+    Other mounts the install needs inside the new system can be added with mount().
+    Use it as a context manager, everything is torn down when it exits,
+    even when the installer crashes.
+    """
+
+    def __init__(self, root: str = "/mnt/gentoo") -> None:
+        """
+        - root: optional path of the new system
+        """
+        self.root = root
+        self._mounts: List[str] = []
+        self._shell: Optional[subprocess.Popen] = None
+
+    def __enter__(self) -> "ChrootSession":
+        self.open()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def mount(self, *args: str, target: str) -> None:
+        """
+        Runs mount with args onto target (relative to the new system's root),
+        and remembers it so it's unmounted by close().
+        """
+        path = f"{self.root}{target}"
+        os.makedirs(path, exist_ok=True)
+        run_command(["mount", *args, path])
+        self._mounts.append(path)
+
+    def open(self) -> None:
+        """
+        Mounts /proc, /sys, /dev and /run, copies resolv.conf and starts the shell.
+        """
+        # Registered first, so a failure halfway still unmounts what was mounted
+        atexit.register(self.close)
+        try:
+            # Copies what the symlink points to, the new system can't see that.
+            # A symlink in the new system is replaced rather than written through
+            resolv_conf = f"{self.root}/etc/resolv.conf"
+            if os.path.islink(resolv_conf):
+                os.unlink(resolv_conf)
+            shutil.copyfile("/etc/resolv.conf", resolv_conf)
+            self.mount("--types", "proc", "/proc", target="/proc")
+            # Slaves, so unmounting inside the chroot doesn't unmount the live system
+            self.mount("--rbind", "/sys", target="/sys")
+            run_command(["mount", "--make-rslave", f"{self.root}/sys"])
+            self.mount("--rbind", "/dev", target="/dev")
+            run_command(["mount", "--make-rslave", f"{self.root}/dev"])
+            self.mount("--bind", "/run", target="/run")
+            run_command(["mount", "--make-slave", f"{self.root}/run"])
+
+            # Outlives this method on purpose, close() stops it.
+            # In a process group of its own, so close() can kill whatever it started
+            self._shell = subprocess.Popen(  # pylint: disable=consider-using-with
+                ["chroot", self.root, "/bin/bash", "--noprofile", "--norc"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                env=ENVIRONMENT,
+                start_new_session=True,
+            )
+            # Not through run(), its subshell would forget the environment right away
+            assert self._shell.stdin is not None
+            self._shell.stdin.write(b"source /etc/profile >/dev/null 2>&1\n")
+        except BaseException:
+            self.close()
+            raise
+
+    def run(
+        self,
+        command: str,
+        on_line: Optional[Callable[[str], None]] = None,
+        check: bool = True,
+    ) -> str:
+        """
+        Runs command in the shell and returns its output (stdout and stderr).
+        - on_line: optional callback which gets each line of output as it comes
+        - check: optionally raise CommandError if the command fails
+        """
+        shell = self._shell
+        if shell is None or shell.poll() is not None:
+            raise RuntimeError("The chroot shell isn't running")
+        # Popen was given stdin and stdout pipes, but mypy doesn't know that
+        assert shell.stdin is not None and shell.stdout is not None
+
+        # The command runs in a subshell so it can't exit (or read) the session's shell,
+        # and things like cd don't carry over to the next command.
+        # Then the marker is printed on a line of its own, followed by the exit status
+        marker = f"__gentooinstall_{uuid.uuid4().hex}__".encode()
+        start = time.perf_counter()
+        shell.stdin.write(
+            b"( "
+            + command.encode("UTF-8")
+            + b"\n) </dev/null 2>&1; printf '\\n%s %d\\n' "
+            + marker
+            + b" $?\n"
+        )
+        shell.stdin.flush()
+
+        lines = []
+        # Each line is handed out once the next one comes in, as the last line
+        # is completed by the newline printed before the marker
+        pending: Optional[bytes] = None
+        while True:
+            line = shell.stdout.readline()
+            if not line:
+                raise RuntimeError("The chroot shell exited while running a command")
+            if line.startswith(marker + b" "):
+                returncode = int(line[len(marker) :])
+                break
+            if pending is not None:
+                lines.append(pending)
+                if on_line is not None:
+                    on_line(pending.decode("UTF-8", errors="replace").rstrip("\n"))
+            pending = line
+        # A lone newline means the command's output already ended with one
+        if pending is not None and pending != b"\n":
+            lines.append(pending)
+            if on_line is not None:
+                on_line(pending.decode("UTF-8", errors="replace").rstrip("\n"))
+        text = b"".join(lines).decode("UTF-8", errors="replace")
+
+        profiler.record_command(
+            ["chroot", self.root, command], time.perf_counter() - start, returncode
+        )
+        if check and returncode != 0:
+            raise CommandError(returncode, command, output=text)
+        return text
+
+    def close(self) -> None:
+        """
+        Stops the shell and lazily unmounts everything, in reverse order.
+        Whatever the shell started and left running (e.g. an interrupted emerge)
+        is killed along with it, so nothing keeps the mounts busy.
+        Lazy unmounts succeed even if something inside the chroot is still busy.
+        Safe to call more than once.
+        """
+        atexit.unregister(self.close)
+        if self._shell is not None:
+            if self._shell.poll() is None:
+                try:
+                    self._shell.communicate(b"exit\n", timeout=EXIT_TIMEOUT)
+                except (subprocess.TimeoutExpired, BrokenPipeError):
+                    pass
+            # The shell leads the group, which outlives it while any child is left
+            with contextlib.suppress(ProcessLookupError):
+                os.killpg(self._shell.pid, signal.SIGKILL)
+            self._shell.wait()
+            self._shell = None
+        while self._mounts:
+            path = self._mounts.pop()
+            try:
+                run_command(["umount", "--lazy", "--recursive", path])
+            except CommandError:
+                # Already gone, nothing left to do
+                pass
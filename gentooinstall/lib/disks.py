@@ -1,11 +1,46 @@
 """
 This module contains (higher level) functions to interact with the disk.
 """
-from copy import deepcopy
-from typing import List, cast
+import os
+from typing import Dict, List, NamedTuple, Optional, Sequence
 
 from .general import run_command
 
+# Buses a disk can hang off of, as they appear in its sysfs path
+TRANSPORTS = ("nvme", "virtio", "mmc", "usb", "ata", "scsi")
+# Buses that queue discards alongside reads and writes (SATA only does on some drives)
+QUEUED_DISCARD_TRANSPORTS = ("nvme", "virtio")
+# Block size of the filesystems made by mkfs, stripe hints are counted in it
+FS_BLOCK_SIZE = 4096
+
+
+class DiskTraits(NamedTuple):
+    """
+    What the kernel knows about a disk, read from sysfs. Sizes are in bytes.
+    """
+
+    rotational: bool
+    discard_granularity: int
+    discard_max_bytes: int
+    minimum_io_size: int
+    optimal_io_size: int
+    transport: str
+
+    @property
+    def discard(self) -> bool:
+        """
+        Whether the disk supports discarding (TRIM).
+        """
+        return self.discard_max_bytes > 0
+
+    @property
+    def queued_discard(self) -> bool:
+        """
+        Whether discarding as files get deleted is cheap on the disk.
+        Elsewhere a periodic fstrim does the job without stalling writes.
+        """
+        return self.discard and self.transport in QUEUED_DISCARD_TRANSPORTS
+
 
 def dict_list_to_list(dict_list: List[dict]) -> List[list]:
     """
@@ -20,42 +55,254 @@ def dict_list_to_list(dict_list: List[dict]) -> List[list]:
     return main_list
 
 
+class BlockDevice:
+    """
+    A disk or partition, as read from sysfs and the udev database.
+    """
+
+    __slots__ = (
+        "name",
+        "size",
+        "label",
+        "fstype",
+        "partitions",
+        "rotational",
+        "removable",
+    )
+
+    def __init__(self, name: str) -> None:
+        """
+        Reads the block device with the given kernel name (e.g. sda or nvme0n1p1).
+        """
+        self.name = name
+        # sysfs always counts in 512 byte sectors, whatever the disk's sector size is
+        self.size: int = _read_int(f"/sys/class/block/{name}/size") * 512
+        udev = _udev_properties(name)
+        self.label: Optional[str] = udev.get("ID_FS_LABEL")
+        self.fstype: Optional[str] = udev.get("ID_FS_TYPE")
+        self.rotational = bool(_read_int(f"/sys/block/{name}/queue/rotational"))
+        self.removable = bool(_read_int(f"/sys/block/{name}/removable"))
+        self.partitions: List[BlockDevice] = []
+        if os.path.isdir(f"/sys/block/{name}"):
+            children = [
+                child
+                for child in os.listdir(f"/sys/block/{name}")
+                if os.path.exists(f"/sys/block/{name}/{child}/partition")
+            ]
+            children.sort(
+                key=lambda child: _read_int(f"/sys/block/{name}/{child}/partition")
+            )
+            self.partitions = [BlockDevice(child) for child in children]
+
+    @property
+    def path(self) -> str:
+        """
+        Returns the device node, e.g. /dev/sda.
+        """
+        return f"/dev/{self.name}"
+
+    def partition_path(self, number: int) -> str:
+        """
+        Returns the device node partition number will get, e.g. /dev/sda1 or /dev/nvme0n1p1.
+        """
+        return partition_path(self.path, number)
+
+
+class Inventory:
+    """
+    The block devices of the system, read once and kept until invalidate() is called.
+    """
+
+    def __init__(self) -> None:
+        self._disks: Optional[List[BlockDevice]] = None
+
+    def disks(self) -> List[BlockDevice]:
+        """
+        Returns the disks the system can be installed to, like lsblk would list them.
+        """
+        if self._disks is None:
+            self._disks = [
+                BlockDevice(name)
+                for name in sorted(os.listdir("/sys/block"))
+                # RAM disks, zram swap and unused loop devices can't be installed to
+                if not name.startswith(("ram", "zram"))
+                and not (
+                    name.startswith("loop")
+                    and not os.path.exists(f"/sys/block/{name}/loop/backing_file")
+                )
+            ]
+            self._disks = [disk for disk in self._disks if disk.size > 0]
+        return self._disks
+
+    def get(self, name: str) -> BlockDevice:
+        """
+        Returns the disk with the given name (e.g. sda) or path (e.g. /dev/sda).
+        """
+        name = os.path.basename(name)
+        for disk in self.disks():
+            if disk.name == name:
+                return disk
+        raise KeyError(f"No disk named {name}")
+
+    def invalidate(self) -> None:
+        """
+        Forgets the block devices, so they are read again (e.g. after partitioning).
+        """
+        self._disks = None
+
+
+inventory = Inventory()
+
+
+def _read_int(path: str) -> int:
+    """
+    Returns the number in a sysfs file, 0 if it can't be read.
+    """
+    try:
+        with open(path, encoding="UTF-8") as file:
+            return int(file.read())
+    except (OSError, ValueError):
+        return 0
+
+
+def _udev_properties(name: str) -> Dict[str, str]:
+    """
+    Returns the properties udev stored for a block device (ID_FS_TYPE, ID_FS_LABEL...).
+    """
+    properties = {}
+    try:
+        with open(f"/sys/class/block/{name}/dev", encoding="UTF-8") as file:
+            device_number = file.read().strip()
+        with open(f"/run/udev/data/b{device_number}", encoding="UTF-8") as file:
+            for line in file:
+                if line.startswith("E:"):
+                    key, _, value = line[2:].rstrip("\n").partition("=")
+                    properties[key] = value
+    except OSError:
+        pass
+    return properties
+
+
+def human_size(size: int) -> str:
+    """
+    Returns a size in bytes the way lsblk shows it, e.g. 256M or 11.7G.
+    """
+    if size < 1024:
+        return f"{size}B"
+    value = float(size)
+    for unit in "KMGT":
+        value /= 1024
+        if value < 1024:
+            return f"{value:.1f}".removesuffix(".0") + unit
+    return f"{value / 1024:.1f}".removesuffix(".0") + "P"
+
+
+def partition_path(path_to_disk: str, number: int) -> str:
+    """
+    Returns the device path of a partition, e.g. /dev/sda1 or /dev/nvme0n1p1.
+    Disks whose name ends with a digit get a "p" before the partition number.
+    """
+    separator = "p" if path_to_disk[-1:].isdigit() else ""
+    return f"{path_to_disk}{separator}{number}"
+
+
 def all_physical_disks() -> List[list]:
     """
     Returns all the physcial disk in the following form:
     [[name, size, label], [name,size,label]]
     """
-    # We're typecasting to avoid mypy complaining
-    out = cast(dict, run_command("lsblk --json -ldo name,size,label", True, True))
-    blockdevices: list = out["blockdevices"]
-    return dict_list_to_list(blockdevices)
+    return [
+        [disk.name, human_size(disk.size), disk.label] for disk in inventory.disks()
+    ]
 
 
 def partitions_in_disk(path_to_disk: str) -> List[list]:
     """
     Returns all the partitions in the disk in the following form:
-    [[name,size,fstype], [name,size,fstype]]
+    [[path,size,fstype], [path,size,fstype]]
     """
-    out = cast(
-        dict,
-        run_command(f"lsblk {path_to_disk} --json -no name,size,fstype", True, True),
+    return [
+        [partition.path, human_size(partition.size), partition.fstype]
+        for partition in inventory.get(path_to_disk).partitions
+    ]
+
+
+def disk_traits(disk: str) -> DiskTraits:
+    """
+    Reads the traits of a disk (e.g. sda or nvme0n1) from /sys/block.
+    Anything that can't be read is assumed to be missing.
+    """
+
+    def queue(name: str) -> int:
+        return _read_int(f"/sys/block/{disk}/queue/{name}")
+
+    device_path = os.path.realpath(f"/sys/block/{disk}")
+    transport = next((bus for bus in TRANSPORTS if f"/{bus}" in device_path), "unknown")
+    return DiskTraits(
+        bool(queue("rotational")),
+        queue("discard_granularity"),
+        queue("discard_max_bytes"),
+        queue("minimum_io_size"),
+        queue("optimal_io_size"),
+        transport,
+    )
+
+
+def discard_disk(path_to_disk: str) -> None:
+    """
+    Discards (TRIMs) every block of the disk in one go.
+    """
+    run_command(["blkdiscard", "--force", path_to_disk])
+
+
+def mkfs_options(fs_type: str, traits: DiskTraits, discarded: bool) -> List[str]:
+    """
+    Returns the mkfs options that make formatting fast on the disk:
+    inode tables and the journal are initialized lazily, nothing is discarded again
+    if the whole disk already was, and the stripe hints match the disk's I/O sizes.
+    - discarded: whether the whole disk was discarded before partitioning
+    """
+    fs_type = fs_type.lower()
+    # Stripe hints only make sense if the disk has a preferred I/O size,
+    # and mkfs refuses a stripe unit that isn't made of whole filesystem blocks
+    striped = (
+        traits.optimal_io_size > traits.minimum_io_size >= FS_BLOCK_SIZE
+        and traits.minimum_io_size % FS_BLOCK_SIZE == 0
+        and traits.optimal_io_size % traits.minimum_io_size == 0
     )
-    partitions = out["blockdevices"][0]["children"]
-    # Remove any children of the partitions
-    for index, partition in enumerate(deepcopy(partitions)):
-        if "children" in partition:
-            partitions[index].pop("children")
-    return dict_list_to_list(partitions)
+    options = []
+    if fs_type in ("ext2", "ext3", "ext4"):
+        extended = ["lazy_itable_init=1", "lazy_journal_init=1"]
+        if discarded:
+            extended.append("nodiscard")
+        if striped:
+            # In filesystem blocks
+            extended.append(f"stride={traits.minimum_io_size // FS_BLOCK_SIZE}")
+            extended.append(f"stripe_width={traits.optimal_io_size // FS_BLOCK_SIZE}")
+        options += ["-E", ",".join(extended)]
+    elif fs_type == "xfs":
+        if discarded:
+            options.append("-K")
+        if striped:
+            stripes = traits.optimal_io_size // traits.minimum_io_size
+            options += ["-d", f"su={traits.minimum_io_size},sw={stripes}"]
+    elif fs_type == "btrfs":
+        if discarded:
+            options.append("--nodiscard")
+    return options
 
 
-def format_filesystem(path_to_part: str, fs_type: str) -> None:
+def format_filesystem(
+    path_to_part: str, fs_type: str, options: Sequence[str] = ()
+) -> None:
     """
     Runs mkfs.fs_type or mkswap to format a partition.
+    - options: optional extra options passed to mkfs, see mkfs_options()
     """
     if fs_type == "swap":
-        run_command(f"mkswap {path_to_part}")
+        run_command(["mkswap", *options, path_to_part])
     else:
-        run_command(f"mkfs.{fs_type.lower()} {path_to_part}")
+        run_command([f"mkfs.{fs_type.lower()}", *options, path_to_part])
 
 
 def mount(path_to_part: str, dest: str, *args: str) -> None:
@@ -63,11 +310,8 @@ def mount(path_to_part: str, dest: str, *args: str) -> None:
     Mounts a partition to the specified location.
     Accepts *args to pass into the mount command.
     """
-    if args:
-        run_command(f"mount {path_to_part} {dest} {' '.join(args)}")
-    else:
-        run_command(f"mount {path_to_part} {dest}")
+    run_command(["mount", path_to_part, dest, *args])
 
     # Change permissions according to gentoo handbook
     if "tmp" in dest:
-        run_command(f"chmod 1777 {dest}")
+        run_command(["chmod", "1777", dest])
@@ -0,0 +1,631 @@
+"""
+This module contains the download engine used to fetch large files (like the stage3 tarball).
+"""
+import json
+import os
+import queue
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import requests
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+
+from .exceptions import NetworkError
+from .network import session
+from .profiling import profiler
+
+# Size of the chunks read from a connection before writing them to disk
+CHUNK_SIZE = 1024 * 1024
+# The file is cut into pieces of this size, which the connections take turns fetching
+PIECE_SIZE = 16 * 1024 * 1024
+# An idle connection only takes over half of a busy one if at least this much is left
+MIN_STEAL_SIZE = 4 * CHUNK_SIZE
+# How many errors in a row a mirror may have before it is no longer used
+MAX_FAILURES = 3
+# A mirror slower than this fraction of the fastest one is no longer used
+SLOW_MIRROR_RATIO = 0.25
+# How long to wait on a connection before it is considered dropped
+TIMEOUT = 30
+# Raised by requests, and by urllib3 while the body is read straight from the socket
+NETWORK_ERRORS = (requests.RequestException, ProtocolError, ReadTimeoutError)
+# How many bytes a segment downloads between two saves of the resume state
+STATE_INTERVAL = 32 * CHUNK_SIZE
+# How many chunks stream() reads ahead of its consumer
+STREAM_BUFFER_CHUNKS = 64
+# Minimum time (in seconds) between two progress callbacks
+PROGRESS_INTERVAL = 0.1
+# Bodies are read straight from the socket, a compressed one would land at the wrong offsets
+IDENTITY = {"Accept-Encoding": "identity"}
+
+
+class Throttle:
+    """
+    Wraps a progress callback, adding up the amounts it is called with
+    and passing them on at most once every PROGRESS_INTERVAL seconds.
+    Redrawing the progress bar for every chunk costs more than the chunk itself on fast links.
+    """
+
+    def __init__(self, advance: Optional[Callable[[int], None]]) -> None:
+        self.advance = advance
+        self._pending = 0
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __call__(self, amount: int) -> None:
+        if self.advance is None:
+            return
+        with self._lock:
+            self._pending += amount
+            now = time.monotonic()
+            if now - self._last < PROGRESS_INTERVAL:
+                return
+            amount, self._pending, self._last = self._pending, 0, now
+        self.advance(amount)
+
+    def flush(self) -> None:
+        """
+        Passes on whatever is left.
+        """
+        if self.advance is None:
+            return
+        with self._lock:
+            amount, self._pending = self._pending, 0
+        if amount:
+            self.advance(amount)
+
+
+def preallocate(descriptor: int, size: int) -> None:
+    """
+    Reserves size bytes for the file, so it isn't fragmented by out of order writes.
+    Falls back to a sparse file if the filesystem can't allocate up front.
+    """
+    try:
+        os.posix_fallocate(descriptor, 0, size)
+    except OSError:
+        os.ftruncate(descriptor, size)
+
+
+class Segment:
+    """
+    Represents a byte range (inclusive start, exclusive end) of the file being downloaded.
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    __slots__ = ("start", "end", "written")
+
+    def __init__(self, start: int, end: int, written: int = 0) -> None:
+        self.start = start
+        self.end = end
+        self.written = written
+
+    @property
+    def remaining(self) -> int:
+        """
+        Returns the amount of bytes that still have to be downloaded.
+        """
+        return self.end - self.start - self.written
+
+
+class Source:
+    """
+    A url the file can be downloaded from, along with how well it has been doing.
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    __slots__ = ("url", "received", "elapsed", "failures", "demoted")
+
+    def __init__(self, url: str) -> None:
+        self.url = url
+        self.received = 0
+        self.elapsed = 0.0
+        self.failures = 0
+        self.demoted = False
+
+    @property
+    def throughput(self) -> Optional[float]:
+        """
+        Returns the measured throughput in bytes per second, or None if nothing was measured yet.
+        """
+        return self.received / self.elapsed if self.elapsed > 0 else None
+
+
+class SegmentedDownload:
+    """
+    Downloads a file over several HTTP Range connections at once,
+    optionally spread over several mirrors of the same file.
+    Each segment is written at its own offset inside a preallocated file,
+    and the progress is kept in a state file next to it so that an interrupted
+    download only fetches the missing bytes when it is ran again.
+    Mirrors that fail or fall far behind the fastest one stop being used,
+    and their unfinished ranges are picked up by the others.
+    Falls back to a single stream if the server doesn't accept ranges.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(
+        self,
+        url: str,
+        path: str,
+        connections: int = 8,
+        mirrors: Optional[List[str]] = None,
+    ) -> None:
+        """
+        Initializes the download, call prepare() before run().
+        - url: url of the file to download
+        - path: where to write the file
+        - connections: maximum amount of concurrent connections
+        - mirrors: optional other urls serving the exact same file
+        """
+        self.url = url
+        self.path = path
+        self.state_path = f"{path}.parts"
+        self.connections = max(1, connections)
+        self.sources = [Source(url)] + [
+            Source(mirror) for mirror in mirrors or [] if mirror != url
+        ]
+        self.total_length: Optional[int] = None
+        self.ranged = False
+        self.segments: List[Segment] = []
+        self._lock = threading.Condition()
+        self._state_lock = threading.Lock()
+        self._pending: List[Segment] = []
+        self._in_flight: Dict[int, Tuple[Segment, Source]] = {}
+        # The first error of a worker, raised again once every worker stopped
+        self._error: Optional[BaseException] = None
+        # Bytes received by the single stream, ranged downloads count them in segments
+        self._received = 0
+        # The file the segments are written into, while a ranged download runs
+        self._descriptor = -1
+
+    @property
+    def completed(self) -> int:
+        """
+        Returns the amount of bytes that are already on disk.
+        """
+        return sum(segment.written for segment in self.segments)
+
+    def prepare(self) -> None:
+        """
+        Asks the sources in turn for the size of the file and if they support ranges,
+        then loads the resume state or splits the file into segments.
+        The first source that answers leads the download, the ones before it are dropped.
+        """
+        error: Optional[requests.RequestException] = None
+        for source in self.sources:
+            try:
+                resp = session.head(source.url, allow_redirects=True, timeout=TIMEOUT)
+                resp.raise_for_status()
+                break
+            except requests.RequestException as exception:
+                # e.g. a mirror which hasn't synced the latest release yet
+                source.demoted = True
+                error = exception
+        else:
+            raise NetworkError(f"Failed to reach: {self.url}") from error
+
+        content_length = resp.headers.get("content-length")
+        if content_length is not None:
+            self.total_length = int(content_length)
+        self.ranged = (
+            self.total_length is not None
+            and resp.headers.get("accept-ranges", "").lower() == "bytes"
+        )
+        # A redirect should only be followed once
+        self.url = source.url = resp.url
+        self.sources.remove(source)
+        self.sources.insert(0, source)
+
+        if self.ranged and not self._load_state():
+            self._split()
+
+    def _split(self) -> None:
+        """
+        Cuts the file into pieces.
+        """
+        # Checked by prepare(), but mypy doesn't know that
+        assert self.total_length is not None
+        self.segments = [
+            Segment(start, min(start + PIECE_SIZE, self.total_length))
+            for start in range(0, self.total_length, PIECE_SIZE)
+        ]
+
+    def _load_state(self) -> bool:
+        """
+        Loads the segments from the state file of a previous run.
+        Returns False if there's nothing (usable) to resume from.
+        """
+        if not (os.path.exists(self.state_path) and os.path.exists(self.path)):
+            return False
+        try:
+            with open(self.state_path, "r", encoding="UTF-8") as file:
+                state = json.load(file)
+        except (OSError, ValueError):
+            return False
+
+        if state.get("url") != self.url or state.get("size") != self.total_length:
+            return False
+        if os.path.getsize(self.path) != self.total_length:
+            return False
+        self.segments = [Segment(*segment) for segment in state["segments"]]
+        return True
+
+    def _save_state(self) -> None:
+        """
+        Writes the current progress of each segment into the state file.
+        """
+        with self._lock:
+            state = {
+                "url": self.url,
+                "size": self.total_length,
+                "segments": [
+                    [segment.start, segment.end, segment.written]
+                    for segment in self.segments
+                ],
+            }
+        with self._state_lock:
+            temp_path = f"{self.state_path}.tmp"
+            with open(temp_path, "w", encoding="UTF-8") as file:
+                json.dump(state, file)
+            os.replace(temp_path, self.state_path)
+
+    def run(self, advance: Optional[Callable[[int], None]] = None) -> None:
+        """
+        Downloads the file.
+        - advance: optional callback which is called with the amount of new bytes written
+        """
+        throttled = Throttle(advance)
+        completed = self.completed
+        start = time.perf_counter()
+        try:
+            if self.ranged:
+                self._run_ranged(throttled)
+            else:
+                self._run_single(throttled)
+        finally:
+            throttled.flush()
+            profiler.record_transfer(
+                self.url,
+                (self.completed - completed) if self.ranged else self._received,
+                time.perf_counter() - start,
+            )
+
+    def _run_ranged(self, advance: Throttle) -> None:
+        """
+        Downloads the missing segments.
+        """
+        # Checked by prepare(), but mypy doesn't know that
+        assert self.total_length is not None
+
+        # Open without truncating so the bytes of a previous run are kept
+        self._descriptor = os.open(self.path, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            # Allocate the file up front so each segment can be written at its offset
+            preallocate(self._descriptor, self.total_length)
+            self._save_state()
+            self._pending = [segment for segment in self.segments if segment.remaining]
+            workers = [
+                threading.Thread(
+                    target=self._worker,
+                    args=(self.sources[index % len(self.sources)], advance),
+                    daemon=True,
+                )
+                for index in range(self.connections)
+            ]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        finally:
+            os.close(self._descriptor)
+            if self.completed != self.total_length:
+                self._save_state()
+
+        if self._error is not None:
+            raise self._error
+        # Only drop the resume state once every byte is known to be on disk
+        if self.completed != self.total_length or any(
+            segment.remaining for segment in self.segments
+        ):
+            raise NetworkError(f"Download left unfinished: {self.url}")
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+    def _pick_source(self, preferred: Source) -> Optional[Source]:
+        """
+        Returns preferred if it is still in use, otherwise the fastest mirror left.
+        Must be called with the lock held.
+        """
+        if not preferred.demoted:
+            return preferred
+        active = [source for source in self.sources if not source.demoted]
+        if not active:
+            return None
+        return max(active, key=lambda source: source.throughput or 0)
+
+    def _next_segment(self) -> Optional[Segment]:
+        """
+        Returns a segment nobody is working on. If there's none left, takes over
+        the second half of the busiest segment in flight.
+        Returns None if there's nothing worth taking.
+        Must be called with the lock held.
+        """
+        if self._pending:
+            return self._pending.pop(0)
+        if not self._in_flight:
+            return None
+        victim = max(
+            (segment for segment, _ in self._in_flight.values()),
+            key=lambda segment: segment.remaining,
+        )
+        # Leave the current chunk of the victim alone, it may be being written right now
+        if victim.remaining - CHUNK_SIZE < 2 * MIN_STEAL_SIZE:
+            return None
+        middle = victim.start + victim.written + CHUNK_SIZE
+        middle += (victim.end - middle) // 2
+        stolen = Segment(middle, victim.end)
+        victim.end = middle
+        self.segments.append(stolen)
+        return stolen
+
+    def _demote_slow_sources(self) -> None:
+        """
+        Stops using the mirrors that are far slower than the fastest one.
+        The last active mirror is always kept.
+        Must be called with the lock held.
+        """
+        measured = [
+            source
+            for source in self.sources
+            if not source.demoted and source.throughput is not None
+        ]
+        if len(measured) < 2:
+            return
+        fastest = max(source.throughput or 0 for source in measured)
+        for source in measured:
+            if (source.throughput or 0) < fastest * SLOW_MIRROR_RATIO:
+                source.demoted = True
+
+    def _claim(self, preferred: Source) -> Optional[Tuple[Segment, Source]]:
+        """
+        Waits for a segment to work on and the source to fetch it from.
+        Returns None once none are left, the download failed or every mirror was dropped.
+        """
+        with self._lock:
+            while True:
+                source = self._pick_source(preferred)
+                if self._error is not None:
+                    return None
+                if source is None:
+                    self._error = NetworkError(
+                        f"Every mirror failed while downloading: {self.url}"
+                    )
+                    self._lock.notify_all()
+                    return None
+                segment = self._next_segment()
+                if segment is not None:
+                    self._in_flight[threading.get_ident()] = (segment, source)
+                    return segment, source
+                if not self._in_flight:
+                    return None
+                # Wait for a busy segment to either finish or fail
+                self._lock.wait()
+
+    def _worker(self, preferred: Source, advance: Throttle) -> None:
+        """
+        Fetches segments until _claim() runs out of them.
+        """
+        # Reused for every read of this connection
+        buffer = memoryview(bytearray(CHUNK_SIZE))
+        while claimed := self._claim(preferred):
+            segment, source = claimed
+            try:
+                self._fetch_segment(segment, source, buffer, advance)
+                with self._lock:
+                    source.failures = 0
+            except (*NETWORK_ERRORS, NetworkError):
+                with self._lock:
+                    source.failures += 1
+                    if source.failures >= MAX_FAILURES:
+                        source.demoted = True
+                    # Somebody else will pick up where this one stopped
+                    if segment.remaining > 0:
+                        self._pending.append(segment)
+            except BaseException as exception:  # pylint: disable=broad-except
+                # e.g. a full disk, the other workers stop and run() raises it
+                with self._lock:
+                    if self._error is None:
+                        self._error = exception
+                return
+            finally:
+                with self._lock:
+                    del self._in_flight[threading.get_ident()]
+                    self._demote_slow_sources()
+                    self._lock.notify_all()
+
+    def _fetch_segment(
+        self,
+        segment: Segment,
+        source: Source,
+        buffer: memoryview,
+        advance: Throttle,
+    ) -> None:
+        """
+        Downloads the missing part of a segment from one source.
+        The end of the segment may move closer while this runs, if another connection takes over.
+        """
+        start_time = time.perf_counter()
+        received = 0
+        unsaved = 0
+        try:
+            with self._lock:
+                offset = segment.start + segment.written
+                headers = {**IDENTITY, "Range": f"bytes={offset}-{segment.end - 1}"}
+            with session.get(
+                source.url, headers=headers, stream=True, timeout=TIMEOUT
+            ) as resp:
+                if resp.status_code != 206:
+                    # The mirror can't take part in a ranged download at all
+                    source.failures = MAX_FAILURES
+                    raise NetworkError(
+                        f"Server ignored range request ({resp.status_code}): {source.url}"
+                    )
+                if not resp.headers.get("content-range", "").endswith(
+                    f"/{self.total_length}"
+                ):
+                    source.failures = MAX_FAILURES
+                    raise NetworkError(f"Mirror has a different file: {source.url}")
+                while not source.demoted:
+                    with self._lock:
+                        # Don't read past the end of the segment
+                        wanted = min(len(buffer), segment.remaining)
+                        offset = segment.start + segment.written
+                    if wanted <= 0:
+                        break
+                    read = resp.raw.readinto(buffer[:wanted])
+                    if not read:
+                        break
+                    os.pwrite(self._descriptor, buffer[:read], offset)
+                    with self._lock:
+                        segment.written += read
+                    advance(read)
+                    received += read
+                    unsaved += read
+                    if unsaved >= STATE_INTERVAL:
+                        self._save_state()
+                        unsaved = 0
+        finally:
+            with self._lock:
+                source.received += received
+                source.elapsed += time.perf_counter() - start_time
+        if segment.remaining > 0:
+            # Either the connection closed early or the mirror was demoted,
+            # in both cases somebody else has to finish the segment
+            raise NetworkError(f"Segment left unfinished: {source.url}")
+
+    def _run_single(self, advance: Throttle) -> None:
+        """
+        Downloads the file over a single stream. Used when the server doesn't support ranges.
+        Works without a content-length too, the file just isn't preallocated then.
+        """
+        buffer = memoryview(bytearray(CHUNK_SIZE))
+        try:
+            with session.get(
+                self.url, headers=IDENTITY, stream=True, timeout=TIMEOUT
+            ) as resp:
+                resp.raise_for_status()
+                descriptor = os.open(
+                    self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644
+                )
+                try:
+                    if self.total_length is not None:
+                        preallocate(descriptor, self.total_length)
+                    written = 0
+                    while True:
+                        read = resp.raw.readinto(buffer)
+                        if not read:
+                            break
+                        view = buffer[:read]
+                        while view:
+                            view = view[os.write(descriptor, view) :]
+                        written += read
+                        self._received = written
+                        advance(read)
+                    # Drop the preallocated space if the server sent less than it said
+                    os.ftruncate(descriptor, written)
+                finally:
+                    os.close(descriptor)
+        except NETWORK_ERRORS as exception:
+            raise NetworkError(f"Failed to download: {self.url}") from exception
+
+
+def _body(
+    url: str, offset: int, on_length: Optional[Callable[[int], None]]
+) -> Iterator[bytes]:
+    """
+    Yields the body of url from offset on, chunk by chunk.
+    """
+    headers = {**IDENTITY, "Range": f"bytes={offset}-"} if offset else IDENTITY
+    with session.get(url, headers=headers, stream=True, timeout=TIMEOUT) as resp:
+        resp.raise_for_status()
+        if offset and resp.status_code != 206:
+            raise NetworkError(
+                f"Server ignored range request ({resp.status_code}): {url}"
+            )
+        content_length = resp.headers.get("content-length")
+        if on_length is not None and content_length is not None:
+            on_length(int(content_length))
+        for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+            if chunk:
+                yield chunk
+
+
+def stream(
+    url: str,
+    advance: Optional[Callable[[int], None]] = None,
+    on_length: Optional[Callable[[int], None]] = None,
+    mirrors: Optional[List[str]] = None,
+) -> Iterator[bytes]:
+    """
+    Yields the body of url chunk by chunk.
+    The body is read by a background thread into a bounded buffer,
+    so the network keeps going while the consumer is busy with a chunk.
+    If url fails, the rest of the body is fetched from the next mirror.
+    - advance: optional callback which is called with the amount of new bytes read
+    - on_length: optional callback which is called with the content-length, if there is one
+    - mirrors: optional other urls serving the exact same file
+    """
+    chunks: queue.Queue[bytes | NetworkError | None] = queue.Queue(STREAM_BUFFER_CHUNKS)
+    cancelled = threading.Event()
+    throttled = Throttle(advance)
+    sources = [url] + [mirror for mirror in mirrors or [] if mirror != url]
+
+    def reader() -> None:
+        received = 0
+        start = time.perf_counter()
+        last_error: Optional[BaseException] = None
+        try:
+            for source in sources:
+                try:
+                    for chunk in _body(
+                        source, received, None if received else on_length
+                    ):
+                        if cancelled.is_set():
+                            return
+                        chunks.put(chunk)
+                        throttled(len(chunk))
+                        received += len(chunk)
+                except (*NETWORK_ERRORS, NetworkError) as exception:
+                    # Carry on from the next mirror, where this one stopped
+                    last_error = exception
+                    continue
+                throttled.flush()
+                chunks.put(None)
+                return
+            error = NetworkError(f"Failed to download: {url}")
+            error.__cause__ = last_error
+            chunks.put(error)
+        finally:
+            profiler.record_transfer(url, received, time.perf_counter() - start)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, NetworkError):
+                raise chunk
+            yield chunk
+    finally:
+        cancelled.set()
+        # Unblock the reader if it is waiting on a full buffer
+        while thread.is_alive():
+            try:
+                chunks.get_nowait()
+            except queue.Empty:
+                thread.join(0.1)
@@ -1,7 +1,9 @@
 """
 This module houses all the exceptions.
 """
+import signal
 import subprocess
+from typing import List, Tuple
 
 
 class NetworkError(Exception):
@@ -39,7 +41,9 @@ class NoNetworkError(Exception):
 
 class CommandError(subprocess.CalledProcessError):
     """
-    Exception raised when a subprocess.run command fails.
+    Exception raised when a command fails.
+    Commands ran by the execution engine only keep their last lines of output
+    (and stderr), see execution.OUTPUT_LINES.
     """
 
     def __init__(
@@ -56,7 +60,43 @@ class CommandError(subprocess.CalledProcessError):
         super().__init__(returncode, cmd, output=output, stderr=stderr)
 
 
+class CommandTimeout(CommandError):
+    """
+    Exception raised when a command is killed because it ran for too long.
+    - timeout: seconds the command was given
+    """
+
+    def __init__(self, cmd, timeout: float, output=None, stderr=None) -> None:
+        # Always killed with SIGKILL
+        super().__init__(-signal.SIGKILL, cmd, output=output, stderr=stderr)
+        self.timeout = timeout
+
+    def __str__(self) -> str:
+        return f"Command '{self.cmd}' timed out after {self.timeout} seconds"
+
+
+class FormatError(Exception):
+    """
+    Exception raised when one or more partitions fail to be formatted.
+    - failures: the path of each partition that failed and the exception it raised
+    """
+
+    def __init__(self, failures: List[Tuple[str, BaseException]]) -> None:
+        self.failures = failures
+        lines = [f"Failed to format {len(failures)} partition(s):"]
+        for path, exception in failures:
+            stderr = getattr(exception, "stderr", None)
+            lines.append(f"{path}: {(stderr or str(exception)).strip()}")
+        super().__init__("\n".join(lines))
+
+
 class HardwareIncompatableError(Exception):
     """
     Exception raised when Hardware is incompatable
     """
+
+
+class DigestMismatchError(Exception):
+    """
+    Exception raised when a downloaded file doesn't match its published digest.
+    """
@@ -0,0 +1,341 @@
+"""
+This module runs commands on an event loop of its own,
+streaming their output line by line instead of holding all of it in memory.
+Commands can be ran from any thread, and independent ones overlap.
+"""
+import asyncio
+import atexit
+import codecs
+import collections
+import concurrent.futures
+import os
+import shlex
+import threading
+import time
+from asyncio.subprocess import DEVNULL, PIPE, Process
+from typing import Callable, Deque, List, NamedTuple, Optional, Sequence, Union
+
+from .exceptions import CommandError, CommandTimeout
+from .profiling import profiler
+
+# Lines of stdout (and of stderr) kept for error reports
+OUTPUT_LINES = 200
+# Commands ran at the same time, most of them wait on disks rather than the CPU
+CONCURRENCY = max(os.cpu_count() or 1, 4)
+# Longest line kept in one piece, longer ones are split, in bytes
+LINE_LIMIT = 1024 * 1024
+
+Command = Union[str, Sequence[str]]
+LineCallback = Callable[[str], None]
+
+
+class RunOptions(NamedTuple):
+    """
+    How a command is ran.
+    - on_stdout: callback which gets each line of stdout as it comes
+    - on_stderr: callback which gets each line of stderr as it comes
+    - stdin: text which is written to the command's input
+    - timeout: seconds after which the command is killed and CommandTimeout is raised
+    - capture: keep all of stdout, instead of only its last lines
+    - check: raise CommandError if the command fails
+    """
+
+    on_stdout: Optional[LineCallback] = None
+    on_stderr: Optional[LineCallback] = None
+    stdin: Optional[str] = None
+    timeout: Optional[float] = None
+    capture: bool = False
+    check: bool = True
+
+
+class Result(NamedTuple):
+    """
+    What a finished command left behind.
+    stdout is only kept in full if it was captured, tail holds its last lines.
+    """
+
+    argv: List[str]
+    returncode: int
+    stdout: Optional[str]
+    tail: List[str]
+    stderr: List[str]
+
+
+class _Output:
+    """
+    The output of a running command: the last lines of stdout and stderr,
+    and all of stdout if it is captured.
+    """
+
+    def __init__(self, lines: int, capture: bool) -> None:
+        self.tail: Deque[str] = collections.deque(maxlen=lines)
+        self.stderr: Deque[str] = collections.deque(maxlen=lines)
+        self.captured: Optional[List[str]] = [] if capture else None
+
+    def error(self, returncode: int, argv: List[str]) -> CommandError:
+        """
+        Returns the CommandError of the command failing with returncode.
+        """
+        return CommandError(returncode, argv, "".join(self.tail), "".join(self.stderr))
+
+    def result(self, returncode: int, argv: List[str]) -> Result:
+        """
+        Returns the Result of the command exiting with returncode.
+        """
+        stdout = None if self.captured is None else "".join(self.captured)
+        return Result(argv, returncode, stdout, list(self.tail), list(self.stderr))
+
+
+def to_argv(command: Command) -> List[str]:
+    """
+    Returns the arguments of a command. A string is split like a shell would,
+    so quoted arguments (e.g. --xattrs-include='*.*') stay in one piece.
+    Commands with paths in them should be given as a list instead.
+    """
+    if isinstance(command, str):
+        return shlex.split(command)
+    return list(command)
+
+
+class Engine:
+    """
+    Runs commands as asyncio subprocesses, on a loop running in a thread of its own.
+    The loop is started by the first command.
+    Callbacks are called from the loop's thread, so they mustn't block
+    (or run commands themselves).
+    """
+
+    def __init__(
+        self, concurrency: int = CONCURRENCY, output_lines: int = OUTPUT_LINES
+    ) -> None:
+        """
+        - concurrency: optional amount of commands ran at the same time
+        - output_lines: optional amount of lines kept for error reports
+        """
+        self.concurrency = concurrency
+        self.output_lines = output_lines
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._lock = threading.Lock()
+
+    def _start(self) -> asyncio.AbstractEventLoop:
+        """
+        Starts the loop (and its thread) if it isn't running yet, and returns it.
+        """
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(
+                    target=loop.run_forever, name="gentooinstall-commands", daemon=True
+                )
+                self._thread.start()
+                self._loop = loop
+                atexit.register(self.close)
+            return self._loop
+
+    async def run_async(
+        self, command: Command, options: RunOptions = RunOptions()
+    ) -> Result:
+        """
+        Runs command once fewer than concurrency commands are running,
+        and returns its result. Cancelling it kills the command.
+        If anything else goes wrong while it runs (e.g. a callback fails),
+        it is killed too and CommandError is raised.
+        - options: optional RunOptions
+        """
+        argv = to_argv(command)
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        output = _Output(self.output_lines, options.capture)
+
+        async with self._semaphore:
+            start = time.perf_counter()
+            process = await asyncio.create_subprocess_exec(
+                *argv,
+                # stdin is a pipe only if there is something to write
+                stdin=DEVNULL if options.stdin is None else PIPE,
+                stdout=PIPE,
+                stderr=PIPE,
+                limit=LINE_LIMIT,
+            )
+            try:
+                returncode = await asyncio.wait_for(
+                    _communicate(process, output, options), options.timeout
+                )
+            except asyncio.TimeoutError:
+                returncode = await _kill(process)
+                profiler.record_command(argv, time.perf_counter() - start, returncode)
+                raise CommandTimeout(
+                    argv,
+                    float(options.timeout or 0),
+                    "".join(output.tail),
+                    "".join(output.stderr),
+                ) from None
+            except Exception as error:
+                # e.g. a callback failed, the command mustn't outlive us
+                returncode = await asyncio.shield(_kill(process))
+                profiler.record_command(argv, time.perf_counter() - start, returncode)
+                raise output.error(returncode, argv) from error
+            except BaseException:
+                # Cancelled, the command mustn't outlive us either
+                await asyncio.shield(_kill(process))
+                raise
+        profiler.record_command(argv, time.perf_counter() - start, returncode)
+
+        if options.check and returncode != 0:
+            raise output.error(returncode, argv)
+        return output.result(returncode, argv)
+
+    def submit(
+        self, command: Command, options: RunOptions = RunOptions()
+    ) -> concurrent.futures.Future:
+        """
+        Starts running command, and returns a future of its result.
+        Cancelling the future kills the command.
+        - options: optional RunOptions
+        """
+        loop = self._start()
+        return asyncio.run_coroutine_threadsafe(self.run_async(command, options), loop)
+
+    def run(self, command: Command, options: RunOptions = RunOptions()) -> Result:
+        """
+        Runs command and waits for its result.
+        - options: optional RunOptions
+        """
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("Commands can't be waited on from a callback")
+        future = self.submit(command, options)
+        try:
+            return future.result()
+        except BaseException:
+            # e.g. KeyboardInterrupt, the command is killed rather than left behind
+            future.cancel()
+            raise
+
+    def run_many(
+        self, commands: Sequence[Command], options: RunOptions = RunOptions()
+    ) -> List[Result]:
+        """
+        Runs independent commands at the same time (up to concurrency of them),
+        and returns their results in order. If one fails the others are killed.
+        - options: optional RunOptions, used for every command
+        """
+        futures = [self.submit(command, options) for command in commands]
+        try:
+            return [future.result() for future in futures]
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    def close(self) -> None:
+        """
+        Kills the commands still running and stops the loop.
+        Safe to call more than once.
+        """
+        atexit.unregister(self.close)
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = self._thread = self._semaphore = None
+        if loop is None or thread is None:
+            return
+
+        async def cancel_all() -> None:
+            tasks = [
+                task
+                for task in asyncio.all_tasks()
+                if task is not asyncio.current_task()
+            ]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(cancel_all(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+async def _read_line(stream: asyncio.StreamReader) -> bytes:
+    """
+    Returns the next line of stream, or b"" at its end.
+    A line longer than LINE_LIMIT comes in pieces, instead of failing like readline.
+    """
+    try:
+        return await stream.readuntil(b"\n")
+    except asyncio.IncompleteReadError as error:
+        # The last line, without a newline
+        return error.partial
+    except asyncio.LimitOverrunError:
+        # At least LINE_LIMIT bytes are buffered, none of them a newline
+        return await stream.read(LINE_LIMIT)
+
+
+async def _pump(
+    stream: Optional[asyncio.StreamReader],
+    lines: Deque[str],
+    callback: Optional[LineCallback],
+    keep: Optional[List[str]] = None,
+) -> None:
+    """
+    Reads stream line by line into lines (and keep), handing each to callback.
+    Pieces of over-long lines count as lines of their own.
+    """
+    # Created with pipes, but mypy doesn't know that
+    assert stream is not None
+    # Incremental, a piece may end halfway through a character
+    decoder = codecs.getincrementaldecoder("UTF-8")(errors="replace")
+    while line := await _read_line(stream):
+        text = decoder.decode(line)
+        lines.append(text)
+        if keep is not None:
+            keep.append(text)
+        if callback is not None:
+            callback(text.rstrip("\n"))
+
+
+async def _feed(process: Process, text: str) -> None:
+    """
+    Writes text to the input of process, then closes it.
+    """
+    # Created with a pipe, but mypy doesn't know that
+    assert process.stdin is not None
+    try:
+        process.stdin.write(text.encode("UTF-8"))
+        await process.stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # The command exited early, its return code tells us why
+        pass
+    finally:
+        process.stdin.close()
+
+
+async def _communicate(process: Process, output: _Output, options: RunOptions) -> int:
+    """
+    Feeds the input of process and reads its output until it exits,
+    and returns its return code.
+    """
+    tasks = [
+        _pump(process.stdout, output.tail, options.on_stdout, output.captured),
+        _pump(process.stderr, output.stderr, options.on_stderr),
+    ]
+    if options.stdin is not None:
+        tasks.append(_feed(process, options.stdin))
+    await asyncio.gather(*tasks)
+    return await process.wait()
+
+
+async def _kill(process: Process) -> int:
+    """
+    Kills process if it's still running, and returns its return code.
+    """
+    if process.returncode is None:
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+    return await process.wait()
+
+
+engine = Engine()
@@ -0,0 +1,398 @@
+"""
+This module contains the engine used to unpack the stage3 tarball.
+Decompression runs in xz (multi-threaded when the archive allows it),
+while the files are written by a pool of threads.
+"""
+import ctypes
+import os
+import shutil
+import stat
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import IO, Callable, Iterable, List, Optional, Tuple, Union
+
+from .exceptions import CommandError
+from .profiling import profiler
+
+# Prefix of the pax headers GNU tar stores xattrs in
+XATTR_PREFIX = "SCHILY.xattr."
+# Upper bound (in bytes) of file contents read from the archive but not written yet
+MAX_BUFFERED = 256 * 1024 * 1024
+# Size of the reads from the decompressor
+READ_SIZE = 1024 * 1024
+
+
+def _xz_totals(path: str) -> Optional[List[str]]:
+    """
+    Returns the totals line of xz --robot --list for the file at path,
+    or None if it can't be read.
+    """
+    try:
+        output = subprocess.run(
+            ["xz", "--robot", "--list", path],
+            check=True,
+            capture_output=True,
+            encoding="UTF-8",
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    for line in output.splitlines():
+        fields = line.split("\t")
+        if fields[0] == "totals":
+            return fields
+    return None
+
+
+def xz_blocks(path: str) -> int:
+    """
+    Returns the amount of xz blocks in the file at path, or 1 if it can't be read.
+    Only multi-block files can be decompressed by several threads.
+    """
+    totals = _xz_totals(path)
+    return int(totals[2]) if totals is not None else 1
+
+
+def xz_size(path: str) -> Optional[int]:
+    """
+    Returns the uncompressed size of the file at path, or None if it can't be read.
+    """
+    totals = _xz_totals(path)
+    return int(totals[4]) if totals is not None else None
+
+
+def decompressor(path: Optional[str] = None) -> List[str]:
+    """
+    Returns the command used to decompress the file at path (or stdin) to stdout.
+    Multi-block files are decompressed by every core, using pixz if it is installed.
+    Single-block files are still decompressed in their own process,
+    which runs alongside the extraction.
+    """
+    # The block count of stdin can't be known up front, xz finds out by itself
+    threaded = path is None or xz_blocks(path) > 1
+    if threaded and path is not None and shutil.which("pixz"):
+        return ["pixz", "-d", "-i", path]
+    command = ["xz", "--decompress", "--stdout"]
+    if threaded:
+        command.append("--threads=0")
+    if path is not None:
+        command.append(path)
+    return command
+
+
+def syncfs(path: str) -> None:
+    """
+    Flushes the filesystem which path is on to disk.
+    """
+    descriptor = os.open(path, os.O_RDONLY)
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.syncfs(descriptor) != 0:
+            os.sync()
+    except (OSError, AttributeError):
+        os.sync()
+    finally:
+        os.close(descriptor)
+
+
+class Extractor:
+    """
+    Unpacks an uncompressed tar stream, keeping permissions, numeric ownership,
+    xattrs, device nodes and modification times.
+    Regular files are written by a pool of threads while the stream is still being read.
+    Nothing is ever written outside of dest, not even through symlinks in the archive.
+    Call extract() with the stream, then finish() once it's known to be complete.
+    """
+
+    def __init__(self, dest: str, workers: Optional[int] = None) -> None:
+        """
+        - dest: directory to extract to
+        - workers: optional amount of threads writing files, defaults to the cpu count
+        """
+        self.dest = os.path.realpath(dest)
+        self.workers = workers or os.cpu_count() or 1
+        self._buffered = threading.Condition()
+        self._buffered_size = 0
+        # Directories get their permissions and times once everything inside them is written
+        self._directories: List[Tuple[str, tarfile.TarInfo]] = []
+        # Hard links are made once their target is surely written
+        self._hardlinks: List[Tuple[str, tarfile.TarInfo]] = []
+        # Directories already known to resolve to somewhere inside dest
+        self._safe_parents = {self.dest}
+
+    def _inside(self, path: str) -> bool:
+        """
+        Returns whether path is dest or somewhere inside of it.
+        """
+        return path == self.dest or path.startswith(self.dest + os.sep)
+
+    def _target(self, name: str) -> str:
+        """
+        Returns where a member is extracted to, creating its parent directories.
+        Absolute names, names with .. in them and parents which are symlinks
+        leading out of dest are refused.
+        """
+        parts = name.split("/")
+        if name.startswith("/") or ".." in parts:
+            raise ValueError(f"Refusing to extract outside of {self.dest}: {name}")
+        path = os.path.normpath(os.path.join(self.dest, name))
+        parent = os.path.dirname(path)
+        if path != self.dest and parent not in self._safe_parents:
+            # Symlinks extracted earlier are followed, wherever they lead
+            if not self._inside(os.path.realpath(parent)):
+                raise ValueError(f"Refusing to extract through a symlink: {name}")
+            os.makedirs(parent, exist_ok=True)
+            self._safe_parents.add(parent)
+        return path
+
+    def extract(
+        self, fileobj: IO[bytes], advance: Optional[Callable[[int], None]] = None
+    ) -> None:
+        """
+        Extracts the tar stream in fileobj.
+        - advance: optional callback which is called with the size of each extracted member
+        """
+        futures: List[Future] = []
+        with tarfile.open(
+            fileobj=fileobj, mode="r|", errors="surrogateescape"
+        ) as archive, ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for member in archive:
+                path = self._target(member.name)
+                if member.isreg():
+                    source = archive.extractfile(member)
+                    # isreg() makes sure there's a file object, but mypy doesn't know that
+                    assert source is not None
+                    if member.size > MAX_BUFFERED:
+                        # Too big to hold in memory, stream it from the archive directly
+                        self._write_stream(path, member, source)
+                    else:
+                        data = source.read()
+                        self._reserve(len(data))
+                        futures.append(
+                            executor.submit(self._write_buffered, path, member, data)
+                        )
+                elif member.isdir():
+                    # Like tar, a symlink in the way is replaced rather than followed
+                    if os.path.islink(path):
+                        os.unlink(path)
+                    os.makedirs(path, exist_ok=True)
+                    self._directories.append((path, member))
+                elif member.islnk():
+                    self._hardlinks.append((path, member))
+                else:
+                    self._make_special(path, member)
+                if advance is not None:
+                    advance(member.size)
+
+            for future in futures:
+                future.result()
+
+    def finish(self) -> None:
+        """
+        Makes the hard links, sets the permissions and times of the directories
+        and flushes everything to disk.
+        Only call it once the whole stream was extracted.
+        """
+        for path, member in self._hardlinks:
+            self._remove(path)
+            os.link(self._target(member.linkname), path, follow_symlinks=False)
+        # Children first, so setting a directory's mtime isn't undone by its children
+        for path, member in reversed(self._directories):
+            self._apply_metadata(path, member)
+        syncfs(self.dest)
+
+    def _reserve(self, size: int) -> None:
+        """
+        Waits until there's room to buffer size more bytes.
+        """
+        with self._buffered:
+            while self._buffered_size and self._buffered_size + size > MAX_BUFFERED:
+                self._buffered.wait()
+            self._buffered_size += size
+
+    def _release(self, size: int) -> None:
+        """
+        Frees size bytes of the buffer.
+        """
+        with self._buffered:
+            self._buffered_size -= size
+            self._buffered.notify_all()
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        """
+        Removes whatever non-directory is at path, so it can be replaced.
+        """
+        if os.path.lexists(path) and not os.path.isdir(path):
+            os.unlink(path)
+
+    def _write_buffered(self, path: str, member: tarfile.TarInfo, data: bytes) -> None:
+        """
+        Writes a regular file from memory.
+        """
+        try:
+            self._remove(path)
+            descriptor = os.open(
+                path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o600
+            )
+            try:
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(descriptor, view) :]
+                self._apply_metadata(descriptor, member)
+            finally:
+                os.close(descriptor)
+        finally:
+            self._release(len(data))
+
+    def _write_stream(
+        self, path: str, member: tarfile.TarInfo, source: IO[bytes]
+    ) -> None:
+        """
+        Writes a regular file straight from the archive.
+        """
+        self._remove(path)
+        with open(path, "wb") as file:
+            shutil.copyfileobj(source, file, READ_SIZE)
+            file.flush()
+            self._apply_metadata(file.fileno(), member)
+
+    def _make_special(self, path: str, member: tarfile.TarInfo) -> None:
+        """
+        Creates symlinks, device nodes and fifos.
+        """
+        self._remove(path)
+        if member.issym():
+            os.symlink(member.linkname, path)
+            os.lchown(path, member.uid, member.gid)
+            os.utime(path, (member.mtime, member.mtime), follow_symlinks=False)
+            return
+        if member.ischr():
+            kind = stat.S_IFCHR
+        elif member.isblk():
+            kind = stat.S_IFBLK
+        elif member.isfifo():
+            kind = stat.S_IFIFO
+        else:
+            # Unknown member types are skipped
+            return
+        os.mknod(path, kind | 0o600, os.makedev(member.devmajor, member.devminor))
+        self._apply_metadata(path, member)
+
+    @staticmethod
+    def _apply_metadata(target: Union[str, int], member: tarfile.TarInfo) -> None:
+        """
+        Sets the ownership, permissions, xattrs and mtime of a path or file descriptor.
+        """
+        # Ownership first, chown clears the setuid and setgid bits
+        os.chown(target, member.uid, member.gid)
+        os.chmod(target, member.mode)
+        for key, value in member.pax_headers.items():
+            if key.startswith(XATTR_PREFIX):
+                os.setxattr(
+                    target,
+                    key[len(XATTR_PREFIX) :],
+                    value.encode("UTF-8", "surrogateescape"),
+                )
+        os.utime(target, (member.mtime, member.mtime))
+
+
+def _run_decompressor(
+    command: List[str],
+    dest: str,
+    advance: Optional[Callable[[int], None]],
+    chunks: Optional[Iterable[bytes]] = None,
+) -> None:
+    """
+    Runs the decompressor and extracts its output.
+    If chunks is given they are fed to the decompressor by a separate thread.
+    """
+    feeder_error: List[BaseException] = []
+    start = time.perf_counter()
+
+    def feed(stdin: IO[bytes]) -> None:
+        # Checked by the caller, but mypy doesn't know that
+        assert chunks is not None
+        try:
+            for chunk in chunks:
+                stdin.write(chunk)
+        except BrokenPipeError:
+            # The decompressor exited early, its return code tells us why
+            pass
+        except BaseException as exception:  # pylint: disable=broad-except
+            feeder_error.append(exception)
+        finally:
+            try:
+                stdin.close()
+            except BrokenPipeError:
+                pass
+
+    # stderr goes to a file so a chatty decompressor can't block on a full pipe
+    with tempfile.TemporaryFile() as error_log, subprocess.Popen(
+        command,
+        stdin=subprocess.PIPE if chunks is not None else subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=error_log,
+    ) as process:
+        # Popen was given stdout=PIPE, but mypy doesn't know that
+        assert process.stdout is not None
+        feeder = None
+        if chunks is not None:
+            feeder = threading.Thread(target=feed, args=(process.stdin,), daemon=True)
+            feeder.start()
+        archive_error: Optional[tarfile.TarError] = None
+        extractor = Extractor(dest)
+        try:
+            extractor.extract(process.stdout, advance)
+        except tarfile.TarError as exception:
+            # Most likely caused by the decompressor failing, which is checked below
+            archive_error = exception
+            process.kill()
+        except BaseException:
+            process.kill()
+            raise
+        finally:
+            if feeder is not None:
+                feeder.join()
+        returncode = process.wait()
+        profiler.record_command(command, time.perf_counter() - start, returncode)
+        error_log.seek(0)
+        stderr = error_log.read().decode("UTF-8", errors="replace")
+
+    if feeder_error:
+        raise feeder_error[0]
+    if archive_error is not None and returncode in (0, -9):
+        raise archive_error
+    if returncode != 0:
+        raise CommandError(returncode, command, stderr=stderr) from archive_error
+    extractor.finish()
+
+
+def extract_file(
+    path: str, dest: str, advance: Optional[Callable[[int], None]] = None
+) -> None:
+    """
+    Unpacks an xz compressed tarball from disk.
+    - path: path of the tarball
+    - dest: directory to extract to
+    - advance: optional callback, see Extractor.extract()
+    """
+    _run_decompressor(decompressor(path), dest, advance)
+
+
+def extract_stream(
+    chunks: Iterable[bytes],
+    dest: str,
+    advance: Optional[Callable[[int], None]] = None,
+) -> None:
+    """
+    Unpacks an xz compressed tarball while it is still being read,
+    so the tarball never has to be written to disk.
+    - chunks: the compressed tarball, in order
+    - dest: directory to extract to
+    - advance: optional callback, see Extractor.extract()
+    """
+    _run_decompressor(decompressor(), dest, advance, chunks)
@@ -2,39 +2,32 @@
 Contains commonly used helper functions
 """
 import json
-import subprocess
-from typing import Union
+from typing import Optional, Union
 
-from .exceptions import CommandError
+from .execution import Command, RunOptions, engine
+
+# Where data that is reused between runs (on the live system) is kept
+CACHE_DIR = "/var/cache/gentooinstall"
 
 
 def run_command(
-    command: str, get_output: bool = False, return_json: bool = False
+    command: Command,
+    get_output: bool = False,
+    return_json: bool = False,
+    stdin: Optional[str] = None,
 ) -> Union[None, dict, str]:
     """
-    Runs a command inside the shell and depending on parameters
-    will return a JSON output
+    Runs a command and depending on parameters will return its output
+    or a JSON output. Raises CommandError if it fails.
+    Give commands with paths in them as a list of arguments, a string is split
+    like a shell would. See execution.engine to stream the output or set a timeout.
+    - stdin: optional text which is written to the command's input
     """
-    # First split the command into multiple parts
-    command_splitted = command.split(" ")
-    try:
-        output = subprocess.run(
-            command_splitted,
-            check=True,
-            capture_output=True,
-            encoding="UTF-8",
-        ).stdout
-    except subprocess.CalledProcessError as exception:
-        raise CommandError(
-            exception.returncode,
-            exception.cmd,
-            exception.output,
-            exception.stderr,
-        ) from exception
+    result = engine.run(command, RunOptions(stdin=stdin, capture=get_output))
 
     # Checks if the user wants an output (or a json one)
     if get_output:
         if return_json:
-            return json.loads(output)
-        return output
+            return json.loads(str(result.stdout))
+        return result.stdout
     return None
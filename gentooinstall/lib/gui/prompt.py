@@ -6,7 +6,7 @@ from typing import Literal, cast
 
 from rich.prompt import IntPrompt, Prompt
 
-from ..disks import all_physical_disks
+from ..disks import inventory
 from .console import console
 from .display import show_all_disks, show_disk_partitions
 
@@ -15,11 +15,9 @@ def select_disk():
     """
     This function prompts the user to select a disk.
     """
+    # The disks are read once, the table and the choices both use them
     show_all_disks()
-    disks_info = all_physical_disks()
-    valid_choices = []
-    for disk_info in disks_info:
-        valid_choices.append(disk_info[0])
+    valid_choices = [disk.name for disk in inventory.disks()]
     selected = Prompt.ask(
         "[green]Please select a disk to begin partitioning:[/green]",
         choices=valid_choices,
@@ -2,61 +2,312 @@
 This module houses the Hardware class used for gathering details about the hardware.
 """
 import os
+from functools import cached_property
 from pathlib import Path
-from typing import List
+from typing import Dict, List, Tuple
 
 CPUINFO = Path("/proc/cpuinfo")
 MEMINFO = Path("/proc/meminfo")
 
+# Memory (in bytes) a compile job can take, C++ heavy packages need about this much.
+# Used both for the job count and for what the portage tmpfs leaves to the jobs
+BUILD_JOB_MEMORY = 2 * 1024 ** 3
+# The CPU_FLAGS_X86 portage knows about, under their /proc/cpuinfo names
+CPU_FLAGS_X86 = {
+    "3dnow": "3dnow",
+    "3dnowext": "3dnowext",
+    "aes": "aes",
+    "avx": "avx",
+    "avx2": "avx2",
+    "avx512_4fmaps": "avx512_4fmaps",
+    "avx512_4vnniw": "avx512_4vnniw",
+    "avx512_bf16": "avx512_bf16",
+    "avx512_bitalg": "avx512_bitalg",
+    "avx512_fp16": "avx512_fp16",
+    "avx512_vbmi2": "avx512_vbmi2",
+    "avx512_vnni": "avx512_vnni",
+    "avx512_vp2intersect": "avx512_vp2intersect",
+    "avx512_vpopcntdq": "avx512_vpopcntdq",
+    "avx512bw": "avx512bw",
+    "avx512cd": "avx512cd",
+    "avx512dq": "avx512dq",
+    "avx512er": "avx512er",
+    "avx512f": "avx512f",
+    "avx512ifma": "avx512ifma",
+    "avx512pf": "avx512pf",
+    "avx512vbmi": "avx512vbmi",
+    "avx512vl": "avx512vl",
+    "avx_vnni": "avx_vnni",
+    "bmi1": "bmi1",
+    "bmi2": "bmi2",
+    "f16c": "f16c",
+    "fma": "fma3",
+    "fma4": "fma4",
+    "mmx": "mmx",
+    "mmxext": "mmxext",
+    "pclmulqdq": "pclmul",
+    "pni": "sse3",
+    "popcnt": "popcnt",
+    "rdrand": "rdrand",
+    "sha_ni": "sha",
+    "sse": "sse",
+    "sse2": "sse2",
+    "sse4_1": "sse4_1",
+    "sse4_2": "sse4_2",
+    "sse4a": "sse4a",
+    "ssse3": "ssse3",
+    "vpclmulqdq": "vpclmulqdq",
+    "xop": "xop",
+}
+# /proc/cpuinfo flags needed by x86-64-v2, v3 and v4, each on top of the last
+X86_64_LEVELS = [
+    {"cx16", "lahf_lm", "pni", "popcnt", "sse4_1", "sse4_2", "ssse3"},
+    {"abm", "avx", "avx2", "bmi1", "bmi2", "f16c", "fma", "movbe", "xsave"},
+    {"avx512f", "avx512bw", "avx512cd", "avx512dq", "avx512vl"},
+]
+# Upper bound (in bytes) of zram swap, compressed pages still take up memory
+MAX_ZRAM_SWAP = 16 * 1024 ** 3
+# Memory (in bytes) kept for the system itself when sizing the portage tmpfs
+MEMORY_RESERVE = 2 * 1024 ** 3
+# Share of the memory left after MEMORY_RESERVE that the portage tmpfs may fill,
+# the compile jobs get the rest. Huge build trees go to disk (see system.NOTMPFS_PACKAGES)
+PORTAGE_TMPFS_SHARE = 0.25
+# A portage tmpfs smaller than this (in bytes) runs out of room too often to be worth it
+MIN_PORTAGE_TMPFS = 2 * 1024 ** 3
 
-def get_cpu_vendor() -> dict:
+
+def cpu_flags_x86(flags: List[str]) -> List[str]:
+    """
+    Returns the value of portage's CPU_FLAGS_X86 for the given cpu flags.
+    """
+    return sorted({CPU_FLAGS_X86[flag] for flag in flags if flag in CPU_FLAGS_X86})
+
+
+def compile_jobs(total_mem: int, cpus: int, tmpfs_size: int = 0) -> int:
+    """
+    Returns how many compile jobs can run at once without running out of memory.
+    - total_mem: total memory in kilobytes, as in Hardware.total_mem
+    - cpus: amount of cpu threads
+    - tmpfs_size: optional size in bytes of the portage tmpfs (see portage_tmpfs_size()),
+      the jobs then only get what the system and the tmpfs leave over
+    """
+    memory = total_mem * 1024
+    if tmpfs_size:
+        memory -= MEMORY_RESERVE + tmpfs_size
+    return max(1, min(cpus, memory // BUILD_JOB_MEMORY))
+
+
+def zram_swap_size(total_mem: int) -> int:
+    """
+    Returns the size in bytes of the zram swap device: half of the memory,
+    which holds about as much as the whole memory once compressed.
+    - total_mem: total memory in kilobytes, as in Hardware.total_mem
+    """
+    return min(total_mem * 1024 // 2, MAX_ZRAM_SWAP) // 1024 ** 2 * 1024 ** 2
+
+
+class CpuInfo:
+    """
+    The cpu, as described by /proc/cpuinfo.
+    Only the first processor is parsed (every core lists the same details),
+    the rest of the file is only looked at to count the cores and threads.
+    Nothing is read until a value is first used.
+    """
+
+    def __init__(self, path: Path = CPUINFO) -> None:
+        """
+        - path: optional file to read instead of /proc/cpuinfo
+        """
+        self.path = path
+
+    @cached_property
+    def _parsed(self) -> Tuple[Dict[str, str], int, int]:
+        """
+        Returns the fields of the first processor, the thread count and the core count.
+        """
+        first: Dict[str, str] = {}
+        threads = 0
+        # (physical id, core id) of every thread, threads of a core share them
+        cores = set()
+        physical_id = ""
+        with self.path.open(encoding="UTF-8") as file:
+            for line in file:
+                if line.startswith("processor"):
+                    threads += 1
+                elif line.startswith("physical id"):
+                    physical_id = line.partition(":")[2].strip()
+                elif line.startswith("core id"):
+                    cores.add((physical_id, line.partition(":")[2].strip()))
+                elif threads == 1 and ":" in line:
+                    key, _, value = line.partition(":")
+                    first[key.strip()] = value.strip()
+        return first, max(threads, 1), max(len(cores), 1)
+
+    @property
+    def vendor(self) -> str:
+        """
+        The vendor id, e.g. GenuineIntel or AuthenticAMD.
+        """
+        return self._parsed[0].get("vendor_id", "")
+
+    @property
+    def model(self) -> str:
+        """
+        The model name, e.g. AMD Ryzen 7 5800X 8-Core Processor.
+        """
+        return self._parsed[0].get("model name", "")
+
+    @property
+    def threads(self) -> int:
+        """
+        The amount of threads (logical cpus).
+        """
+        return self._parsed[1]
+
+    @property
+    def cores(self) -> int:
+        """
+        The amount of physical cores.
+        """
+        return self._parsed[2]
+
+    @cached_property
+    def flags(self) -> List[str]:
+        """
+        The ISA extensions the cpu supports, as named in /proc/cpuinfo.
+        """
+        return self._parsed[0].get("flags", "").split()
+
+    @property
+    def x86_64_level(self) -> int:
+        """
+        The highest x86-64 microarchitecture level (1 to 4) the cpu supports.
+        """
+        level = 1
+        for required in X86_64_LEVELS:
+            if not required.issubset(self.flags):
+                break
+            level += 1
+        return level
+
+
+class MemInfo:
     """
-    Gets the cpu vendor
+    The memory of the machine, as described by /proc/meminfo. Sizes are in bytes.
+    Nothing is read until a value is first used.
     """
-    cpu = {"intel": False, "amd": False}
-    with CPUINFO.open(encoding="UTF-8") as file:
-        for line in file:
-            if "GenuineIntel" in line:
-                cpu["intel"] = True
-            elif "AuthenticAMD" in line:
-                cpu["amd"] = True
-    return cpu
+
+    def __init__(self, path: Path = MEMINFO) -> None:
+        """
+        - path: optional file to read instead of /proc/meminfo
+        """
+        self.path = path
+
+    @cached_property
+    def _fields(self) -> Dict[str, int]:
+        """
+        Returns MemTotal and MemAvailable in bytes, the rest of the file isn't read.
+        """
+        fields = {}
+        with self.path.open(encoding="UTF-8") as file:
+            for line in file:
+                key, _, value = line.partition(":")
+                if key in ("MemTotal", "MemAvailable"):
+                    # The values are in kB (really KiB)
+                    fields[key] = int(value.split()[0]) * 1024
+                    if len(fields) == 2:
+                        break
+        return fields
+
+    @property
+    def total(self) -> int:
+        """
+        Total usable memory.
+        """
+        return self._fields["MemTotal"]
+
+    @property
+    def available(self) -> int:
+        """
+        Memory that can be used without swapping.
+        """
+        return self._fields.get("MemAvailable", self.total)
 
 
-def get_mem_total() -> int:
+def portage_tmpfs_size(total_mem: int) -> int:
     """
-    Gets total memory of device in kilobytes
+    Returns the size in bytes of the tmpfs portage builds in, 0 if it shouldn't have one.
+    The tmpfs gets PORTAGE_TMPFS_SHARE of the memory the system leaves over,
+    compile_jobs() then fits the jobs in the rest.
+    - total_mem: total memory in kilobytes, as in Hardware.total_mem
     """
-    memory = 0
-    with MEMINFO.open(encoding="UTF-8") as file:
-        memory = int(file.readline().split(":")[1].lstrip().split("kB")[0].rstrip())
-    return memory
+    size = int((total_mem * 1024 - MEMORY_RESERVE) * PORTAGE_TMPFS_SHARE)
+    if size < MIN_PORTAGE_TMPFS:
+        return 0
+    # Round down to whole MiB, tmpfs sizes are written as such
+    return size // 1024 ** 2 * 1024 ** 2
 
 
 class Hardware:
     """
-    Stores details about the device
+    Stores details about the device.
+    The details are only read when they are first used.
     """
 
     # We can remove this one later when we finish the required_package
     # pylint: disable=fixme, no-self-use
 
-    def __init__(self) -> None:
+    def __init__(self, cpuinfo: Path = CPUINFO, meminfo: Path = MEMINFO) -> None:
+        """
+        - cpuinfo: optional file to read instead of /proc/cpuinfo
+        - meminfo: optional file to read instead of /proc/meminfo
+        """
+        self.cpuinfo = CpuInfo(cpuinfo)
+        self.meminfo = MemInfo(meminfo)
+
+    @property
+    def cpu(self) -> dict:
+        """
+        Which vendor the cpu is from, as {"intel": bool, "amd": bool}.
+        """
+        return {
+            "intel": self.cpuinfo.vendor == "GenuineIntel",
+            "amd": self.cpuinfo.vendor == "AuthenticAMD",
+        }
+
+    @property
+    def cpu_flags(self) -> List[str]:
+        """
+        The ISA extensions the cpu supports.
+        """
+        return self.cpuinfo.flags
+
+    @property
+    def cpus(self) -> int:
+        """
+        The amount of threads compile jobs can run on.
+        """
+        return self.cpuinfo.threads
+
+    @property
+    def total_mem(self) -> int:
         """
-        Initializes class and assigns the following:
-        - self.cpu
-        - self.total_ram
-        - self.uefi
+        Total memory in kilobytes.
         """
-        self.cpu = get_cpu_vendor()
-        self.total_mem = get_mem_total()
-        self.uefi = os.path.isdir("/sys/firmware/efi")
+        return self.meminfo.total // 1024
+
+    @property
+    def uefi(self) -> bool:
+        """
+        Whether the machine booted with UEFI.
+        """
+        return os.path.isdir("/sys/firmware/efi")
 
     def suggested_swap_size(self) -> int:
         """
         Returns the suggested swap size in gigbytes
         """
-        ram_in_gigs = int(str(self.total_mem)[0])
+        ram_in_gigs = max(round(self.meminfo.total / 1024 ** 3), 1)
         if ram_in_gigs <= 5:
             swap_size = ram_in_gigs * 2
         elif ram_in_gigs <= 15:
@@ -65,6 +316,32 @@ class Hardware:
             swap_size = 4
         return swap_size
 
+    def zram_swap_size(self) -> int:
+        """
+        Returns the size in bytes of the zram swap device, see zram_swap_size().
+        """
+        return zram_swap_size(self.total_mem)
+
+    def cpu_flags_x86(self) -> List[str]:
+        """
+        Returns the value of portage's CPU_FLAGS_X86 for this cpu.
+        """
+        return cpu_flags_x86(self.cpu_flags)
+
+    def compile_jobs(self, tmpfs_size: int = 0) -> int:
+        """
+        Returns how many compile jobs can run at once, see compile_jobs().
+        - tmpfs_size: optional size in bytes of the portage tmpfs
+        """
+        return compile_jobs(self.total_mem, self.cpus, tmpfs_size)
+
+    def portage_tmpfs_size(self) -> int:
+        """
+        Returns the size in bytes of the tmpfs portage builds in, 0 if it shouldn't have one.
+        See portage_tmpfs_size().
+        """
+        return portage_tmpfs_size(self.total_mem)
+
     def hardware_compatable(self) -> bool:
         """
         Checks compatability of the hardware
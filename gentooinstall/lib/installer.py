@@ -2,20 +2,23 @@
 This module houses the real brains of the script
 """
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from copy import deepcopy
+from typing import Literal
 
 import requests
 from rich.progress import Progress
 from rich.prompt import Prompt
 
-from . import disks, system
-from .exceptions import HardwareIncompatableError, NoNetworkError
-from .fdisk import Fdisk
+from . import disks, mounts, network, partitioning, system, zram
+from .chroot import ChrootSession
+from .exceptions import FormatError, HardwareIncompatableError, NoNetworkError
 from .general import run_command
 from .gui import display, prompt
 from .gui.components import table
 from .gui.console import console
 from .hardware import hardware
+from .profiling import profiler
 from .storage import storage
 
 
@@ -41,7 +44,7 @@ def preliminary_checks():
             # Try making request to google, if this doesn't throw an error we can proceed
             check_internet = progress.add_task("[yellow]Checking Internet...[/yellow]")
             progress.update(check_internet, advance=50)
-            requests.get("http://www.gooogle.com", timeout=7)
+            network.session.get("http://www.gooogle.com", timeout=7)
             progress.update(check_internet, advance=50)
         except (requests.ConnectionError, requests.Timeout) as exception:
             raise NoNetworkError from exception
@@ -52,7 +55,7 @@ def preliminary_checks():
                 "[yellow]Syncing system time with NTP...[/yellow]"
             )
             progress.update(set_system_time_ntp, advance=50)
-            run_command("timedatectl set-ntp true")
+            run_command(["timedatectl", "set-ntp", "true"])
             progress.update(set_system_time_ntp, advance=50)
 
 
@@ -69,19 +72,6 @@ def store_disk_scheme() -> None:
     storage.part_scheme = scheme_choice
     # Store the scheme-specific data into storage
     if scheme_choice == 1:
-        # Pylint thinks we can't check if a substring is in a string
-        # pylint: disable=unsupported-membership-test
-        if "nvme" in selected_disk:
-            efi_or_bios = f"/dev/{selected_disk}p1"
-            swap = f"/dev/{selected_disk}p2"
-            root = f"/dev/{selected_disk}p3"
-        elif "sd" in selected_disk:
-            efi_or_bios = f"/dev/{selected_disk}1"
-            swap = f"/dev/{selected_disk}2"
-            root = f"/dev/{selected_disk}3"
-        else:
-            HardwareIncompatableError("HDD not supported")
-
         # Prompts the user to select a partitioning format
         root_fs = Prompt.ask(
             "[green]What filesystem do you want to use for your root partition?[/green]",
@@ -91,20 +81,14 @@ def store_disk_scheme() -> None:
         # Stores the scheme in storage.
         storage.partitions = [
             {
-                "name": efi_or_bios,
+                "name": "",
                 # If its efi then we use vfat otherwise we use ext4
                 "type": "vfat" if hardware.uefi else "ext4",
                 "size": "256M",
                 "mountpoint": "/boot/efi" if hardware.uefi else "/boot",
             },
             {
-                "name": swap,
-                "type": "swap",
-                "size": f"{hardware.suggested_swap_size()}G",
-                "mountpoint": "swap",
-            },
-            {
-                "name": root,
+                "name": "",
                 "type": root_fs,
                 "size": "full",
                 "mountpoint": "/"
@@ -112,6 +96,21 @@ def store_disk_scheme() -> None:
                 else {"@": "/", "@home": "/home"},
             },
         ]
+        # zram can take the place of the swap partition
+        if storage.args["zram_swap"] != "instead":
+            storage.partitions.insert(
+                1,
+                {
+                    "name": "",
+                    "type": "swap",
+                    "size": f"{hardware.suggested_swap_size()}G",
+                    "mountpoint": "swap",
+                },
+            )
+        # The kernel names partitions differently depending on the disk (sda1, nvme0n1p1)
+        disk = disks.inventory.get(selected_disk)
+        for number, partition in enumerate(storage.partitions, 1):
+            partition["name"] = disk.partition_path(number)
     elif scheme_choice == 2:
         console.print(
             "[bold italic yellow]Ensure you've formatted and ran mkfs or mkswap on your partitions."
@@ -158,63 +157,275 @@ def partition_selected_disk() -> None:
             progress.update(partitioning_disk, advance=40)
             if storage.partitions is None:
                 raise ValueError("storage.partitions is None")
-            # Spawn an fdisk instance
-            fdisk = Fdisk(f"/dev/{storage.disk}")
-            if hardware.uefi:
-                fdisk.create_gpt_table()
-                for partition in storage.partitions:
-                    if partition["type"] == "swap":
-                        fdisk.create_gpt_part(f"+{partition['size']}", "swap")
-                    else:
-                        if partition["size"] != "full":
-                            fdisk.create_gpt_part(f"+{partition['size']}", None)
-                        else:
-                            # Fdisk interprets an empty string as 'take up whole space'
-                            fdisk.create_gpt_part("", None)
-            else:
-                fdisk.create_dos_table()
-                for partition in storage.partitions:
-                    if partition["type"] == "swap":
-                        fdisk.create_dos_part(f"+{partition['size']}", True, "swap")
-                    else:
-                        if partition["size"] != "full":
-                            fdisk.create_dos_part(f"+{partition['size']}", True, None)
-                        else:
-                            fdisk.create_dos_part("", True, None)
-
+            # One discard of the whole SSD is much faster than mkfs discarding each partition
+            traits = disks.disk_traits(storage.disk)
+            if storage.args["fast_format"] and traits.discard and not traits.rotational:
+                disks.discard_disk(f"/dev/{storage.disk}")
+                storage.formatting["discarded"] = True
+            # The whole table is written at once
+            paths = partitioning.apply_layout(
+                f"/dev/{storage.disk}", storage.partitions, hardware.uefi
+            )
             progress.update(partitioning_disk, advance=50)
-            fdisk.write_changes()
+            # The kernel's names for the partitions are the ones to use from now on
+            for partition, path in zip(storage.partitions, paths):
+                partition["name"] = path
+            disks.inventory.invalidate()
             progress.update(partitioning_disk, advance=10)
 
 
 def format_selected_partitions() -> None:
     """
     Formats the partitions that the installation will use.
+    The partitions are independent, so up to storage.args["format_jobs"] of them
+    are formatted at once. Every failure is reported together once all are done.
     """
     if storage.part_scheme == 1:
         if storage.partitions is None:
             raise ValueError("storage.partitions is None")
-        with Progress(expand=True) as progress:
-            format_part = progress.add_task(
-                "[yellow]Formatting partitions...", start=False
-            )
+        failures = []
+        traits = disks.disk_traits(storage.disk)
+        with Progress(expand=True) as progress, ThreadPoolExecutor(
+            max_workers=storage.args["format_jobs"]
+        ) as executor:
+            futures = {}
             for partition in storage.partitions:
-                disks.format_filesystem(partition["name"], partition["type"])
-            progress.advance(format_part, 100)
+                # Pulses until mkfs finishes, as it doesn't report its progress
+                task = progress.add_task(
+                    f"[yellow]Formatting {partition['name']} ({partition['type']})...",
+                    total=1,
+                    start=False,
+                )
+                options = []
+                if storage.args["fast_format"]:
+                    options = disks.mkfs_options(
+                        partition["type"], traits, storage.formatting["discarded"]
+                    )
+                storage.formatting["options"][partition["name"]] = options
+                future = executor.submit(
+                    disks.format_filesystem,
+                    partition["name"],
+                    partition["type"],
+                    options,
+                )
+                futures[future] = (partition, task)
+            for future in as_completed(futures):
+                partition, task = futures[future]
+                progress.start_task(task)
+                exception = future.exception()
+                if exception is None:
+                    progress.update(
+                        task,
+                        completed=1,
+                        description=f"[green]Formatted {partition['name']}",
+                    )
+                else:
+                    failures.append((partition["name"], exception))
+                    progress.update(
+                        task, description=f"[red]Failed to format {partition['name']}"
+                    )
+        # The filesystems on the disk changed
+        disks.inventory.invalidate()
+        if failures:
+            raise FormatError(failures)
 
 
 def mount_selected_partitions() -> None:
     """
-    Loops through the partitions in storage.partitions and mount them
+    Plans the mounts of the partitions in storage.partitions,
+    creates the btrfs subvolumes they use and mounts them in order.
+    Then turns on the zram swap, if asked to.
     """
     if storage.part_scheme != 3:
         if storage.partitions is None:
             raise ValueError("storage.partitions is None")
-        for partition in storage.partitions:
-            if partition["mountpoint"] != "swap":
-                disks.mount(partition["name"], "/mnt/gentoo" + partition["mountpoint"])
-            else:
-                run_command(f"swapon {partition['name']}")
+        entries = mounts.plan_mounts(
+            storage.partitions,
+            disks.disk_traits(storage.disk),
+            storage.args["btrfs_compression"],
+        )
+        if storage.part_scheme == 1:
+            # Only freshly formatted filesystems are missing their subvolumes
+            mounts.create_subvolumes(entries)
+        mounts.mount_all(entries, storage.mountpoint)
+        storage.mounts = [entry._asdict() for entry in entries]
+    if storage.args["zram_swap"] != "off":
+        # Lets the compile jobs later on use more memory without running out of it
+        zram.activate(hardware.zram_swap_size(), storage.args["zram_algorithm"])
+
+
+def write_fstab() -> None:
+    """
+    Adds the mounts to the fstab of the new system, once the stage3 is in place.
+    """
+    if storage.mounts:
+        mounts.write_fstab(
+            [mounts.MountEntry(**entry) for entry in storage.mounts],
+            storage.mountpoint,
+        )
+
+
+def portage_tmpfs_size() -> int:
+    """
+    Returns the size in bytes of the tmpfs portage builds in, 0 if there's none.
+    """
+    if storage.args["no_portage_tmpfs"]:
+        return 0
+    return hardware.portage_tmpfs_size()
+
+
+def configure_portage_tmpdir(chroot: ChrootSession) -> None:
+    """
+    Sets up a tmpfs for portage to build in, sized from the memory of the machine.
+    It is mounted for the rest of the session too, so the install builds in it.
+    """
+    size = portage_tmpfs_size()
+    if size == 0:
+        return
+    tmpfs = system.setup_portage_tmpfs(storage.mountpoint, size)
+    chroot.mount(
+        "--types",
+        tmpfs.fstype,
+        "--options",
+        ",".join(tmpfs.options),
+        tmpfs.source,
+        target=tmpfs.target,
+    )
+
+
+def configure_zram_swap(
+    stage3_variant: Literal["openrc", "systemd", "desktop-openrc", "desktop-systemd"]
+) -> None:
+    """
+    Makes the new system use the same zram swap as the install, if asked to.
+    """
+    if storage.args["zram_swap"] == "off":
+        return
+    zram.persist(
+        storage.mountpoint,
+        hardware.zram_swap_size(),
+        storage.args["zram_algorithm"],
+        "systemd" if stage3_variant.endswith("systemd") else "openrc",
+    )
+
+
+def configure_make_conf(chroot: ChrootSession) -> None:
+    """
+    Writes a make.conf tuned for this machine into the new system.
+    The caches it uses are mounted for the rest of the session.
+    """
+    make_conf = system.MakeConf()
+    make_conf.march = storage.args["march"]
+    make_conf.tune(
+        hardware.cpus,
+        # The jobs only get what the portage tmpfs leaves over
+        hardware.compile_jobs(portage_tmpfs_size()),
+        # -march=native enables whatever this cpu has, otherwise the flags could be wrong
+        hardware.cpu_flags_x86() if make_conf.march == "native" else [],
+    )
+    if configure_binary_packages(chroot):
+        make_conf.features.append("getbinpkg")
+    if storage.args["binpkg_cache"] is not None:
+        # Everything built from source ends up in the cache,
+        # and whatever an earlier install put in there is used instead of building it
+        make_conf.features.append("buildpkg")
+        make_conf.emerge_options.append("--usepkg")
+    if configure_build_caches(chroot):
+        make_conf.features.append("ccache")
+        make_conf.variables["CCACHE_DIR"] = system.CCACHE_DIR
+        make_conf.variables["CCACHE_SIZE"] = f"{storage.args['ccache_size']}G"
+    make_conf.write(storage.mountpoint)
+
+
+def configure_build_caches(chroot: ChrootSession) -> bool:
+    """
+    Bind mounts the distfiles and ccache directories of the live system
+    into the new system, if asked to.
+    Returns whether ccache is used.
+    """
+    if storage.args["distfiles_cache"] is not None:
+        system.bind_cache(chroot, storage.args["distfiles_cache"], system.DISTDIR)
+    if storage.args["ccache"] is None:
+        return False
+    system.setup_ccache(
+        storage.args["ccache"], storage.args["ccache_size"] * 1024 * 1024 * 1024
+    )
+    system.bind_cache(chroot, storage.args["ccache"], system.CCACHE_DIR)
+    return True
+
+
+def report_cache_stats() -> None:
+    """
+    Shows how well the compiler cache did during the install.
+    """
+    if storage.args["ccache"] is None:
+        return
+    stats = system.ccache_stats(storage.args["ccache"])
+    if stats is None:
+        return
+    hits, misses = stats
+    if hits + misses:
+        console.print(
+            f"[cyan]ccache: {hits} hits, {misses} misses "
+            f"({hits / (hits + misses):.0%} hit rate)[/cyan]"
+        )
+
+
+def configure_binary_packages(chroot: ChrootSession) -> bool:
+    """
+    Sets up the binhost and the binary package cache, if asked to.
+    Returns whether packages should be fetched from the binhost.
+    """
+    if storage.args["binpkg_cache"] is not None:
+        system.bind_cache(chroot, storage.args["binpkg_cache"], system.PKGDIR)
+    url = storage.args["binhost"]
+    if url is None:
+        return False
+    if url == "official":
+        url = system.official_binhost(hardware.cpuinfo.x86_64_level)
+    if not system.binhost_reachable(url):
+        display.warn(f"The binhost at {url} can't be reached, building from source.")
+        return False
+    system.setup_binhost(storage.mountpoint, url)
+    return True
+
+
+def sync_portage(chroot: ChrootSession) -> None:
+    """
+    Downloads the latest snapshot of the portage tree inside the new system.
+    """
+    with Progress(expand=True) as progress:
+        syncing = progress.add_task("[yellow]Syncing the portage tree...", start=False)
+        chroot.run("emerge-webrsync")
+        progress.start_task(syncing)
+        progress.advance(syncing, 100)
+
+
+def install_support_packages(
+    chroot: ChrootSession,
+    stage3_variant: Literal["openrc", "systemd", "desktop-openrc", "desktop-systemd"],
+) -> None:
+    """
+    Emerges what the configuration written so far relies on,
+    before anything else is built:
+    - dev-util/ccache, which FEATURES="ccache" in make.conf needs
+    - sys-apps/zram-generator, which reads the zram swap config on systemd
+    """
+    packages = []
+    if storage.args["ccache"] is not None:
+        packages.append("dev-util/ccache")
+    if storage.args["zram_swap"] != "off" and stage3_variant.endswith("systemd"):
+        packages.append("sys-apps/zram-generator")
+    if not packages:
+        return
+    with Progress(expand=True) as progress:
+        installing = progress.add_task(
+            f"[yellow]Installing {', '.join(packages)}...", start=False
+        )
+        # Portage refuses FEATURES="ccache" until ccache is installed
+        chroot.run(f'FEATURES="-ccache" emerge --noreplace {" ".join(packages)}')
+        progress.start_task(installing)
+        progress.advance(installing, 100)
 
 
 def execute() -> None:
@@ -224,12 +435,16 @@ def execute() -> None:
     display.show_welcome()
     display.show_options()
 
+    profiler.capture = storage.args["profile"]
+
     # Run checks before starting install
-    preliminary_checks()
+    with profiler.phase("Preliminary checks"):
+        preliminary_checks()
 
     # Start disk partitioning
     console.rule("Step 1: Partitioning the disks")
-    store_disk_scheme()
+    with profiler.phase("Disk scheme"):
+        store_disk_scheme()
     # Confirm the user's choices
     if storage.partitions is not None:
         partitions_copy = deepcopy(storage.partitions)
@@ -255,13 +470,44 @@ def execute() -> None:
     if confirm == "n":
         console.print("[red]No changes made[/red]")
         sys.exit()
-    partition_selected_disk()
-    format_selected_partitions()
-    mount_selected_partitions()
+    with profiler.phase("Partitioning"):
+        partition_selected_disk()
+    with profiler.phase("Formatting"):
+        format_selected_partitions()
+    with profiler.phase("Mounting"):
+        mount_selected_partitions()
 
     # Selecting a and installing tarball
     console.rule("Step 2: Installing the Gentoo installation files")
     stage3_variant = prompt.select_stage3()
-    system.install_stage3(
-        stage3_variant, optimal_mirror=not storage.args["no_optimal_mirror"]
-    )
+    with profiler.phase("Installing stage3"):
+        system.install_stage3(
+            stage3_variant,
+            optimal_mirror=not storage.args["no_optimal_mirror"],
+            options=system.Stage3Options(
+                stream=storage.args["stream_stage3"],
+                cache_dir=storage.args["stage3_cache"],
+                cache_size=storage.args["stage3_cache_size"] * 1024 * 1024 * 1024,
+            ),
+        )
+
+    # Everything from here on runs inside the new system,
+    # whatever is mounted into it is unmounted when the session ends
+    with ChrootSession(storage.mountpoint) as chroot:
+        with profiler.phase("Configuring portage"):
+            write_fstab()
+            configure_portage_tmpdir(chroot)
+            configure_zram_swap(stage3_variant)
+            configure_make_conf(chroot)
+
+        console.rule("Step 3: Setting up Portage")
+        with profiler.phase("Syncing portage"):
+            sync_portage(chroot)
+        with profiler.phase("Installing support packages"):
+            install_support_packages(chroot, stage3_variant)
+
+    report_cache_stats()
+    # Records the choices made, including the mkfs options, in the new system
+    storage.export_config()
+    # Keep the timings next to the exported config
+    profiler.export(storage.mountpoint)
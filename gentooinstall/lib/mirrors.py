@@ -0,0 +1,195 @@
+"""
+This module finds the fastest Gentoo mirrors by measuring them.
+"""
+import io
+import json
+import os
+import re
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple, Optional
+from urllib.parse import urlparse
+from xml.etree import ElementTree
+
+import requests
+
+from .general import CACHE_DIR
+from .network import get_cached, session
+
+MIRRORS_XML = "https://api.gentoo.org/mirrors/distfiles.xml"
+MIRRORS_PAGE = "https://www.gentoo.org/downloads/mirrors/"
+# A large file every mirror carries, a small range of it is used to measure throughput
+PROBE_PATH = "snapshots/portage-latest.tar.xz"
+PROBE_SIZE = 256 * 1024
+PROBE_TIMEOUT = 5
+PROBE_WORKERS = 32
+# Only the mirrors with the lowest connect time get their throughput measured
+SHORTLIST_SIZE = 12
+# How long (in seconds) a ranking stays valid
+CACHE_TTL = 6 * 60 * 60
+CACHE_PATH = os.path.join(CACHE_DIR, "mirrors.json")
+
+
+class Mirror(NamedTuple):
+    """
+    A mirror and the measurements it was ranked with.
+    """
+
+    url: str
+    latency: float
+    throughput: float
+
+
+def candidate_mirrors() -> List[str]:
+    """
+    Returns the url of every http(s) distfiles mirror.
+    Urls always end with a /
+    """
+    try:
+        return _parse_mirrors_xml(get_cached(MIRRORS_XML))
+    except (requests.RequestException, ElementTree.ParseError):
+        return _scrape_mirrors()
+
+
+def _parse_mirrors_xml(text: str) -> List[str]:
+    """
+    Parses the mirror list published by api.gentoo.org.
+    """
+    urls = []
+    for _, element in ElementTree.iterparse(io.StringIO(text)):
+        if element.tag == "uri" and element.get("protocol") in ("http", "https"):
+            url = (element.text or "").strip().rstrip("/") + "/"
+            if url != "/" and url not in urls:
+                urls.append(url)
+        element.clear()
+    return urls
+
+
+def _scrape_mirrors() -> List[str]:
+    """
+    Finds the mirrors on the gentoo.org mirrors page.
+    """
+    # Only needed when the mirror list fails, so it isn't imported up front
+    # pylint: disable=import-outside-toplevel
+    from bs4 import BeautifulSoup  # type: ignore
+
+    mirrors_soup = BeautifulSoup(get_cached(MIRRORS_PAGE), "html.parser")
+    urls = []
+    for table in mirrors_soup.find_all("table"):
+        for link in table.find_all("a", attrs={"href": re.compile(r"https?://.*")}):
+            url = link.get("href").rstrip("/") + "/"
+            if url not in urls:
+                urls.append(url)
+    return urls
+
+
+def connect_time(url: str) -> Optional[float]:
+    """
+    Returns how long (in seconds) opening a TCP connection to the mirror takes.
+    Returns None if the mirror can't be reached.
+    """
+    parsed = urlparse(url)
+    port = parsed.port or (443 if parsed.scheme == "https" else 80)
+    start = time.perf_counter()
+    try:
+        with socket.create_connection((parsed.hostname, port), PROBE_TIMEOUT):
+            return time.perf_counter() - start
+    except OSError:
+        return None
+
+
+def throughput(url: str) -> Optional[float]:
+    """
+    Returns the throughput (in bytes per second) of a small ranged read from the mirror.
+    The time includes the request itself, so slow to respond mirrors rank lower.
+    Returns None if the mirror fails the read.
+    """
+    start = time.perf_counter()
+    received = 0
+    try:
+        with session.get(
+            url + PROBE_PATH,
+            headers={"Range": f"bytes=0-{PROBE_SIZE - 1}"},
+            stream=True,
+            timeout=PROBE_TIMEOUT,
+        ) as resp:
+            resp.raise_for_status()
+            # Stop early in case the mirror ignores the range and sends everything
+            for chunk in resp.iter_content(chunk_size=64 * 1024):
+                received += len(chunk)
+                if received >= PROBE_SIZE:
+                    break
+    except requests.RequestException:
+        return None
+    elapsed = time.perf_counter() - start
+    return received / elapsed if elapsed > 0 else None
+
+
+def rank_mirrors(candidates: List[str]) -> List[Mirror]:
+    """
+    Measures the candidates in parallel and returns them, fastest first.
+    Mirrors that can't be reached are left out.
+    """
+    with ThreadPoolExecutor(max_workers=PROBE_WORKERS) as executor:
+        latencies = list(executor.map(connect_time, candidates))
+        reachable = sorted(
+            (latency, url)
+            for latency, url in zip(latencies, candidates)
+            if latency is not None
+        )[:SHORTLIST_SIZE]
+        speeds = executor.map(lambda pair: throughput(pair[1]), reachable)
+        ranking = [
+            Mirror(url, latency, speed)
+            for (latency, url), speed in zip(reachable, speeds)
+            if speed is not None
+        ]
+    return sorted(ranking, key=lambda mirror: mirror.throughput, reverse=True)
+
+
+def _load_ranking() -> Optional[List[Mirror]]:
+    """
+    Returns the cached ranking, or None if there is no fresh one.
+    """
+    try:
+        with open(CACHE_PATH, "r", encoding="UTF-8") as file:
+            cache = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if time.time() - cache.get("timestamp", 0) > CACHE_TTL:
+        return None
+    return [Mirror(*mirror) for mirror in cache["mirrors"]]
+
+
+def _save_ranking(ranking: List[Mirror]) -> None:
+    """
+    Writes the ranking into the cache along with the current time.
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    temp_path = f"{CACHE_PATH}.tmp"
+    with open(temp_path, "w", encoding="UTF-8") as file:
+        json.dump({"timestamp": time.time(), "mirrors": ranking}, file, indent=2)
+    os.replace(temp_path, CACHE_PATH)
+
+
+def ranked_mirrors(refresh: bool = False) -> List[Mirror]:
+    """
+    Returns the mirrors, fastest first.
+    The ranking is cached on disk for CACHE_TTL seconds, unless refresh is set.
+    """
+    if not refresh:
+        ranking = _load_ranking()
+        if ranking:
+            return ranking
+    ranking = rank_mirrors(candidate_mirrors())
+    if ranking:
+        _save_ranking(ranking)
+    return ranking
+
+
+def best_mirror() -> Optional[str]:
+    """
+    Returns the url of the fastest mirror, or None if no mirror could be measured.
+    """
+    ranking = ranked_mirrors()
+    return ranking[0].url if ranking else None
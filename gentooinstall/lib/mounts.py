@@ -0,0 +1,172 @@
+"""
+This module plans how the partitions are mounted (including btrfs subvolumes),
+mounts them, and writes the matching fstab.
+"""
+import os
+import tempfile
+from pathlib import PurePosixPath
+from typing import List, NamedTuple, Optional
+
+from . import disks
+from .disks import DiskTraits
+from .execution import RunOptions, engine
+from .general import run_command
+
+# Filesystems which don't need atime, the stage3 and portage never rely on it
+ATIME_FREE = ("ext2", "ext3", "ext4", "xfs", "btrfs")
+FSTAB_HEADER = "# Added by gentooinstall"
+
+
+class MountEntry(NamedTuple):
+    """
+    A filesystem to mount (or swap to enable), and its fstab line.
+    The target is relative to the new system's root.
+    """
+
+    source: str
+    target: str
+    fstype: str
+    options: List[str]
+    subvolume: Optional[str] = None
+
+
+def btrfs_options(traits: DiskTraits, compression: int) -> List[str]:
+    """
+    Returns the btrfs mount options suited to the disk.
+    Compression means less is written, which speeds up extracting on slow disks.
+    - compression: zstd level, 0 turns compression off
+    """
+    options = ["noatime"]
+    if compression > 0:
+        options.append(f"compress=zstd:{compression}")
+    if not traits.rotational:
+        options.append("ssd")
+        if traits.queued_discard:
+            options.append("discard=async")
+        elif traits.discard:
+            # Recent kernels turn async discard on by themselves, which stalls SATA
+            options.append("nodiscard")
+    return options
+
+
+def plan_mounts(
+    partitions: List[dict], traits: DiskTraits, compression: int = 3
+) -> List[MountEntry]:
+    """
+    Turns storage.partitions into mount entries, ordered so that every mountpoint
+    is mounted after the one it lives in (/ before /home before /home/user...).
+    A btrfs partition whose mountpoint is a dict (subvolume: mountpoint)
+    gets an entry per subvolume. Swap entries come last.
+    """
+    entries = []
+    swaps = []
+    for partition in partitions:
+        fstype = partition["type"]
+        if partition["mountpoint"] == "swap":
+            swaps.append(MountEntry(partition["name"], "none", "swap", ["sw"]))
+            continue
+        if fstype == "btrfs":
+            options = btrfs_options(traits, compression)
+        elif fstype in ATIME_FREE:
+            options = ["noatime"]
+        else:
+            options = ["defaults"]
+        if isinstance(partition["mountpoint"], dict):
+            for subvolume, target in partition["mountpoint"].items():
+                entries.append(
+                    MountEntry(
+                        partition["name"],
+                        target,
+                        fstype,
+                        options + [f"subvol={subvolume}"],
+                        subvolume,
+                    )
+                )
+        else:
+            entries.append(
+                MountEntry(partition["name"], partition["mountpoint"], fstype, options)
+            )
+    entries.sort(key=lambda entry: len(PurePosixPath(entry.target).parts))
+    return entries + swaps
+
+
+def create_subvolumes(entries: List[MountEntry]) -> None:
+    """
+    Creates the btrfs subvolumes used by the entries.
+    Each filesystem is mounted once, at its top level, to create them.
+    """
+    subvolumes: dict = {}
+    for entry in entries:
+        if entry.subvolume is not None:
+            subvolumes.setdefault(entry.source, []).append(entry.subvolume)
+    for source, names in subvolumes.items():
+        with tempfile.TemporaryDirectory(prefix="gentooinstall-") as top_level:
+            # Not through disks.mount(), which would chmod the top level because
+            # of the "tmp" in its path
+            run_command(["mount", "-o", "subvolid=5", source, top_level])
+            try:
+                for name in names:
+                    path = os.path.join(top_level, name)
+                    if not os.path.isdir(path):
+                        run_command(["btrfs", "subvolume", "create", path])
+            finally:
+                run_command(["umount", top_level])
+
+
+def mount_all(entries: List[MountEntry], root: str) -> None:
+    """
+    Mounts the entries under root in order, and enables the swap entries.
+    """
+    for entry in entries:
+        if entry.fstype == "swap":
+            run_command(["swapon", entry.source])
+            continue
+        dest = root + entry.target.rstrip("/")
+        os.makedirs(dest, exist_ok=True)
+        disks.mount(entry.source, dest, "-o", ",".join(entry.options))
+
+
+def fstab_lines(entries: List[MountEntry]) -> List[str]:
+    """
+    Returns the fstab line of each entry. Filesystems are referred to by UUID,
+    as the device names can change between boots.
+    """
+    # Virtual filesystems like tmpfs have nothing to look up.
+    # The lookups don't depend on each other, so they run at the same time
+    devices = sorted(
+        {entry.source for entry in entries if entry.source.startswith("/dev/")}
+    )
+    results = engine.run_many(
+        [["blkid", "-s", "UUID", "-o", "value", device] for device in devices],
+        RunOptions(capture=True),
+    )
+    uuids = {
+        device: str(result.stdout).strip() for device, result in zip(devices, results)
+    }
+    lines = []
+    for entry in entries:
+        source = entry.source
+        if uuids.get(source):
+            source = f"UUID={uuids[source]}"
+        # Only ext filesystems are checked by fsck at boot, the root one first
+        if entry.fstype.startswith("ext"):
+            passno = 1 if entry.target == "/" else 2
+        else:
+            passno = 0
+        lines.append(
+            f"{source}\t{entry.target}\t{entry.fstype}\t{','.join(entry.options)}"
+            f"\t0 {passno}"
+        )
+    return lines
+
+
+def write_fstab(entries: List[MountEntry], root: str) -> None:
+    """
+    Appends the entries to the fstab of the new system (which comes with the stage3).
+    """
+    path = os.path.join(root, "etc/fstab")
+    with open(path, "a+", encoding="UTF-8") as file:
+        file.seek(0)
+        if FSTAB_HEADER not in file.read():
+            file.write(f"\n{FSTAB_HEADER}\n")
+        file.write("\n".join(fstab_lines(entries)) + "\n")
@@ -0,0 +1,111 @@
+"""
+This module houses the HTTP session shared by the whole program,
+and a cache for small pages that rarely change.
+"""
+import hashlib
+import json
+import os
+import time
+from typing import Any
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .general import CACHE_DIR
+from .profiling import profiler
+
+# Used for requests that don't set their own timeout: (connect, read) in seconds
+DEFAULT_TIMEOUT = (10, 30)
+# Connections kept alive per host, the download engine opens several to the same mirror
+POOL_SIZE = 16
+HTTP_CACHE_DIR = os.path.join(CACHE_DIR, "http")
+
+
+class Session(requests.Session):
+    """
+    requests.Session which always has a timeout,
+    and records the transfers that aren't streamed in the profiler.
+    Streamed transfers are recorded by whoever reads them.
+    """
+
+    def request(self, *args: Any, **kwargs: Any) -> requests.Response:
+        # pylint: disable=arguments-differ
+        kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+        start = time.perf_counter()
+        resp = super().request(*args, **kwargs)
+        if not kwargs.get("stream"):
+            profiler.record_transfer(
+                resp.url, len(resp.content), time.perf_counter() - start
+            )
+        return resp
+
+
+def new_session() -> Session:
+    """
+    Returns a session that keeps connections alive
+    and retries failed connections and server errors.
+    """
+    retries = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset(["GET", "HEAD"]),
+        # Hand the last response back instead of raising, callers check the status
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retries
+    )
+    new = Session()
+    new.mount("http://", adapter)
+    new.mount("https://", adapter)
+    return new
+
+
+session = new_session()
+
+
+def get_cached(url: str) -> str:
+    """
+    Returns the body of url as text.
+    The body is kept on disk along with its ETag and Last-Modified headers,
+    so later calls only download it again if it changed.
+    """
+    os.makedirs(HTTP_CACHE_DIR, exist_ok=True)
+    cache_path = os.path.join(
+        HTTP_CACHE_DIR, hashlib.sha256(url.encode("UTF-8")).hexdigest() + ".json"
+    )
+    cached = None
+    try:
+        with open(cache_path, "r", encoding="UTF-8") as file:
+            cached = json.load(file)
+    except (OSError, ValueError):
+        pass
+
+    headers = {}
+    if cached is not None:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+    resp = session.get(url, headers=headers)
+    if resp.status_code == 304 and cached is not None:
+        return cached["body"]
+    resp.raise_for_status()
+
+    if resp.headers.get("etag") or resp.headers.get("last-modified"):
+        temp_path = f"{cache_path}.tmp"
+        with open(temp_path, "w", encoding="UTF-8") as file:
+            json.dump(
+                {
+                    "url": url,
+                    "etag": resp.headers.get("etag"),
+                    "last_modified": resp.headers.get("last-modified"),
+                    "body": resp.text,
+                },
+                file,
+            )
+        os.replace(temp_path, cache_path)
+    return resp.text
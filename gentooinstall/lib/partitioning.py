@@ -0,0 +1,140 @@
+"""
+This module turns the partitions in storage into a partition table,
+and applies the whole table in one go, with sfdisk or parttable.
+"""
+import os
+import shutil
+from typing import List, Literal, Optional
+
+from . import parttable
+from .disks import partition_path
+from .general import run_command
+from .parttable import ALIGNMENT, Extent
+
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4, "P": 1024 ** 5}
+
+
+def parse_size(size: str) -> Optional[int]:
+    """
+    Returns the amount of bytes in a size like "256M" or "8G" (binary units, like fdisk).
+    Returns None for "full".
+    """
+    if size == "full":
+        return None
+    size = size.strip().upper().removesuffix("IB").removesuffix("B")
+    if size[-1:] in UNITS:
+        return int(float(size[:-1]) * UNITS[size[-1]])
+    return int(size)
+
+
+def sector_size(path_to_disk: str) -> int:
+    """
+    Returns the logical sector size of the disk, 512 if it isn't a block device.
+    """
+    name = os.path.basename(os.path.realpath(path_to_disk))
+    try:
+        with open(
+            f"/sys/block/{name}/queue/logical_block_size", encoding="UTF-8"
+        ) as file:
+            return int(file.read())
+    except (OSError, ValueError):
+        return 512
+
+
+def partition_kind(partition: dict, uefi: bool) -> Literal["esp", "swap", "linux"]:
+    """
+    Returns what kind of partition a storage.partitions entry is.
+    """
+    if partition["type"] == "swap":
+        return "swap"
+    if uefi and partition["mountpoint"] == "/boot/efi":
+        return "esp"
+    return "linux"
+
+
+def plan_layout(partitions: List[dict], uefi: bool, sector: int = 512) -> List[Extent]:
+    """
+    Places the partitions one after the other, each starting on a 1 MiB boundary.
+    - partitions: storage.partitions
+    - uefi: whether the disk boots with UEFI (GPT) or BIOS (DOS)
+    - sector: logical sector size of the disk
+    """
+    align = ALIGNMENT // sector
+    layout = []
+    start = align
+    for partition in partitions:
+        size = parse_size(partition["size"])
+        # Rounded up to whole MiBs
+        sectors = None
+        if size is not None:
+            sectors = (size + ALIGNMENT - 1) // ALIGNMENT * align
+        layout.append(
+            Extent(
+                start,
+                sectors,
+                partition_kind(partition, uefi),
+                # BIOS boots from the partition mounted at /boot
+                not uefi and partition["mountpoint"] == "/boot",
+            )
+        )
+        if sectors is None:
+            break
+        start += sectors
+    return layout
+
+
+def sfdisk_script(layout: List[Extent], label: Literal["gpt", "dos"]) -> str:
+    """
+    Returns the sfdisk script that creates the layout.
+    """
+    types = parttable.GPT_TYPES if label == "gpt" else parttable.DOS_TYPES
+    lines = [f"label: {label}", ""]
+    for extent in layout:
+        fields = [f"start={extent.start}"]
+        if extent.size is not None:
+            fields.append(f"size={extent.size}")
+        fields.append(f"type={types[extent.kind]}")
+        if extent.bootable:
+            fields.append("bootable")
+        lines.append(", ".join(fields))
+    return "\n".join(lines) + "\n"
+
+
+def attach_image(path: str) -> str:
+    """
+    Attaches an image file to a free loop device, with its partitions scanned,
+    and returns the path of the loop device (e.g. /dev/loop0).
+    """
+    return str(
+        run_command(["losetup", "--find", "--show", "--partscan", path], True)
+    ).strip()
+
+
+def apply_layout(path_to_disk: str, partitions: List[dict], uefi: bool) -> List[str]:
+    """
+    Wipes the disk and writes the whole partition table in a single sfdisk run.
+    Image files (and disks, if sfdisk isn't installed) get the table from parttable,
+    without running any program.
+    Works on block devices and on image files.
+    Returns the device paths of the new partitions, in order.
+    An image file is attached to a loop device (see attach_image()) so that its
+    partitions get device paths, the loop device stays attached for the caller
+    (losetup --detach undoes it).
+    """
+    sector = sector_size(path_to_disk)
+    layout = plan_layout(partitions, uefi, sector)
+    label: Literal["gpt", "dos"] = "gpt" if uefi else "dos"
+    if os.path.isfile(path_to_disk) or not shutil.which("sfdisk"):
+        parttable.write_table(path_to_disk, layout, label, sector)
+    else:
+        run_command(
+            ["sfdisk", "--wipe", "always", "--wipe-partitions", "always", path_to_disk],
+            stdin=sfdisk_script(layout, label),
+        )
+    device = path_to_disk
+    if os.path.isfile(path_to_disk):
+        device = attach_image(path_to_disk)
+    # Wait for udev to create the partition nodes
+    if shutil.which("udevadm"):
+        run_command(["udevadm", "settle"])
+    return [partition_path(device, index + 1) for index in range(len(layout))]
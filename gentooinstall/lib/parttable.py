@@ -0,0 +1,207 @@
+"""
+This module writes GPT and DOS partition tables straight to a disk or image file,
+without running any other program.
+"""
+import fcntl
+import os
+import stat
+import struct
+import uuid
+import zlib
+from typing import List, Literal, NamedTuple, Optional
+
+# Partitions start and end on 1 MiB boundaries
+ALIGNMENT = 1024 * 1024
+
+GPT_TYPES = {
+    "esp": "C12A7328-F81F-11D2-BA4B-00A0C93EC93B",
+    "swap": "0657FD6D-A4AB-43C4-84E5-0933C84B4F4F",
+    "linux": "0FC63DAF-8483-4772-8E79-3D69E4477DE4",
+}
+DOS_TYPES = {"esp": "ef", "swap": "82", "linux": "83"}
+
+
+class Extent(NamedTuple):
+    """
+    Where a partition goes on the disk, in sectors.
+    A size of None takes up the rest of the disk.
+    """
+
+    start: int
+    size: Optional[int]
+    kind: Literal["esp", "swap", "linux"]
+    bootable: bool
+
+
+# Partition entries in a GPT, and the size of each entry
+GPT_ENTRIES = 128
+GPT_ENTRY_SIZE = 128
+GPT_HEADER = struct.Struct("<8sIIIIQQQQ16sQIII")
+GPT_ENTRY = struct.Struct("<16s16sQQQ72s")
+MBR_ENTRY = struct.Struct("<B3sB3sII")
+# Re-read partition table ioctl, see linux/fs.h
+BLKRRPART = 0x125F
+
+
+def _chs(lba: int) -> bytes:
+    """
+    Returns the CHS address of an LBA, using the usual 255 heads and 63 sectors.
+    Addresses past what CHS can hold are clamped, as everyone reads the LBA instead.
+    """
+    cylinder, rest = divmod(lba, 255 * 63)
+    if cylinder > 1023:
+        return b"\xfe\xff\xff"
+    head, sector = divmod(rest, 63)
+    return bytes([head, ((cylinder >> 2) & 0xC0) | (sector + 1), cylinder & 0xFF])
+
+
+def _mbr_entry(bootable: bool, kind: int, start: int, size: int) -> bytes:
+    """
+    Returns a partition entry of an MBR.
+    """
+    return MBR_ENTRY.pack(
+        0x80 if bootable else 0,
+        _chs(start),
+        kind,
+        _chs(start + size - 1),
+        start,
+        size,
+    )
+
+
+def _mbr(entries: List[bytes], signature: bytes = b"\0" * 4) -> bytes:
+    """
+    Returns the 512 byte MBR holding up to 4 partition entries.
+    """
+    table = b"".join(entries).ljust(4 * MBR_ENTRY.size, b"\0")
+    return b"\0" * 440 + signature + b"\0\0" + table + b"\x55\xaa"
+
+
+def disk_size(descriptor: int) -> int:
+    """
+    Returns the size in bytes of an open disk or image file.
+    """
+    return os.lseek(descriptor, 0, os.SEEK_END)
+
+
+def gpt(layout: List[Extent], sectors: int, sector: int = 512) -> List[tuple]:
+    """
+    Returns the (offset, data) writes that make up a GPT:
+    the protective MBR, the primary header and entries, and the backup entries and header.
+    - layout: partitions to create, see partitioning.plan_layout()
+    - sectors: size of the disk in sectors
+    - sector: logical sector size of the disk
+    """
+    entry_sectors = GPT_ENTRIES * GPT_ENTRY_SIZE // sector
+    last_lba = sectors - 1
+    first_usable = 2 + entry_sectors
+    last_usable = last_lba - entry_sectors - 1
+
+    entries = bytearray(GPT_ENTRIES * GPT_ENTRY_SIZE)
+    for index, extent in enumerate(layout):
+        end = last_usable if extent.size is None else extent.start + extent.size - 1
+        if extent.start < first_usable or end > last_usable:
+            raise ValueError(f"Partition {index + 1} doesn't fit on the disk")
+        GPT_ENTRY.pack_into(
+            entries,
+            index * GPT_ENTRY_SIZE,
+            uuid.UUID(GPT_TYPES[extent.kind]).bytes_le,
+            uuid.uuid4().bytes_le,
+            extent.start,
+            end,
+            0,
+            b"",
+        )
+    entries_crc = zlib.crc32(entries)
+    disk_guid = uuid.uuid4().bytes_le
+
+    def header(current: int, backup: int, entries_lba: int) -> bytes:
+        fields = [
+            b"EFI PART",
+            0x00010000,
+            GPT_HEADER.size,
+            0,
+            0,
+            current,
+            backup,
+            first_usable,
+            last_usable,
+            disk_guid,
+            entries_lba,
+            GPT_ENTRIES,
+            GPT_ENTRY_SIZE,
+            entries_crc,
+        ]
+        # The CRC is calculated with the CRC field set to 0
+        fields[3] = zlib.crc32(GPT_HEADER.pack(*fields))
+        return GPT_HEADER.pack(*fields).ljust(sector, b"\0")
+
+    protective = _mbr_entry(False, 0xEE, 1, min(last_lba, 0xFFFFFFFF))
+    return [
+        # LBA 0 to the end of the primary entries in one write
+        (
+            0,
+            _mbr([protective]).ljust(sector, b"\0")
+            + header(1, last_lba, 2)
+            + bytes(entries),
+        ),
+        # Backup entries and the backup header right after them, in one write
+        (
+            (last_usable + 1) * sector,
+            bytes(entries) + header(last_lba, 1, last_usable + 1),
+        ),
+    ]
+
+
+def dos(layout: List[Extent], sectors: int, sector: int = 512) -> List[tuple]:
+    """
+    Returns the (offset, data) write that makes up a DOS partition table.
+    Only primary partitions are supported, so there can't be more than 4.
+    """
+    if len(layout) > 4:
+        raise ValueError("A DOS partition table holds at most 4 primary partitions")
+    entries = []
+    for index, extent in enumerate(layout):
+        size = sectors - extent.start if extent.size is None else extent.size
+        if extent.start + size > min(sectors, 0x100000000):
+            raise ValueError(f"Partition {index + 1} doesn't fit on the disk")
+        kind = int(DOS_TYPES[extent.kind], 16)
+        entries.append(_mbr_entry(extent.bootable, kind, extent.start, size))
+    return [(0, _mbr(entries, os.urandom(4)).ljust(sector, b"\0"))]
+
+
+def write_table(
+    path_to_disk: str,
+    layout: List[Extent],
+    label: Literal["gpt", "dos"],
+    sector: int = 512,
+    size: Optional[int] = None,
+) -> None:
+    """
+    Writes a partition table to a disk or image file, replacing whatever was there.
+    The start of each partition is zeroed so old filesystem signatures are gone.
+    - layout: partitions to create, see partitioning.plan_layout()
+    - sector: logical sector size of the disk
+    - size: optional size in bytes to (sparsely) resize an image file to
+    """
+    descriptor = os.open(path_to_disk, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+    try:
+        is_device = stat.S_ISBLK(os.fstat(descriptor).st_mode)
+        if size is not None and not is_device:
+            os.ftruncate(descriptor, size)
+        sectors = disk_size(descriptor) // sector
+        writes = (gpt if label == "gpt" else dos)(layout, sectors, sector)
+
+        # Everything before the first partition goes, along with any old table in it
+        os.pwrite(descriptor, bytes(ALIGNMENT), 0)
+        for extent in layout:
+            os.pwrite(descriptor, bytes(ALIGNMENT), extent.start * sector)
+        for offset, data in writes:
+            os.pwrite(descriptor, data, offset)
+        os.fsync(descriptor)
+
+        if is_device:
+            # Tell the kernel about the new partitions
+            fcntl.ioctl(descriptor, BLKRRPART)
+    finally:
+        os.close(descriptor)
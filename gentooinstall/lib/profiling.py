@@ -0,0 +1,132 @@
+"""
+This module records where the time of an install run goes.
+"""
+import cProfile
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, TypedDict
+
+
+class PhaseRecord(TypedDict):
+    """
+    What was recorded of a phase. throughput is in bytes per second.
+    """
+
+    name: str
+    seconds: float
+    bytes: int
+    throughput: Optional[float]
+
+
+class Profiler:
+    """
+    Records the wall time, bytes moved and throughput of each phase of the install,
+    along with every command ran and every HTTP transfer.
+    Optionally captures cProfile data for each phase (of the main thread).
+    """
+
+    def __init__(self) -> None:
+        self.capture = False
+        self.phases: List[PhaseRecord] = []
+        self.commands: List[dict] = []
+        self.transfers: List[dict] = []
+        self._current: Optional[PhaseRecord] = None
+        self._profiles: List[tuple] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """
+        Context manager which records everything ran inside of it as the phase name.
+        """
+        record: PhaseRecord = {
+            "name": name,
+            "seconds": 0.0,
+            "bytes": 0,
+            "throughput": None,
+        }
+        with self._lock:
+            self._current = record
+        profile = cProfile.Profile() if self.capture else None
+        start = time.perf_counter()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                self._profiles.append((name, profile))
+            with self._lock:
+                record["seconds"] = time.perf_counter() - start
+                if record["bytes"] and record["seconds"] > 0:
+                    record["throughput"] = record["bytes"] / record["seconds"]
+                self.phases.append(record)
+                self._current = None
+
+    def record_command(
+        self, command: List[str], seconds: float, returncode: int
+    ) -> None:
+        """
+        Records a command that was ran.
+        """
+        with self._lock:
+            self.commands.append(
+                {
+                    "phase": self._current["name"] if self._current else None,
+                    "command": command,
+                    "seconds": seconds,
+                    "returncode": returncode,
+                }
+            )
+
+    def record_transfer(self, url: str, length: int, seconds: float) -> None:
+        """
+        Records an HTTP transfer, its bytes count towards the current phase.
+        """
+        with self._lock:
+            self.transfers.append(
+                {
+                    "phase": self._current["name"] if self._current else None,
+                    "url": url,
+                    "bytes": length,
+                    "seconds": seconds,
+                    "throughput": length / seconds if seconds > 0 else None,
+                }
+            )
+            if self._current is not None:
+                self._current["bytes"] += length
+
+    def export(
+        self, mountpoint: str, path: str = "/gentooinstall-profile.json"
+    ) -> None:
+        """
+        Writes the report into a JSON file located within the mountpoint.
+        The cProfile data, if captured, goes into a directory next to it (one file per phase).
+        """
+        # Make sure that the path specified startes with a /
+        if not path.startswith("/"):
+            path = "/" + path
+
+        with self._lock:
+            report = {
+                "phases": self.phases,
+                "commands": self.commands,
+                "transfers": self.transfers,
+            }
+        with open(f"{mountpoint}{path}", "w", encoding="UTF-8") as file:
+            json.dump(report, file, indent=2)
+
+        if self._profiles:
+            profile_dir = f"{mountpoint}{os.path.splitext(path)[0]}"
+            os.makedirs(profile_dir, exist_ok=True)
+            for index, (name, profile) in enumerate(self._profiles):
+                slug = re.sub(r"[^a-z0-9]+", "-", name.lower()).strip("-")
+                profile.dump_stats(os.path.join(profile_dir, f"{index:02}-{slug}.prof"))
+
+
+profiler = Profiler()
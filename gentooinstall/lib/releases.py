@@ -0,0 +1,103 @@
+"""
+This module finds the latest Gentoo releases using the small index files
+published next to them in the release tree.
+"""
+import re
+from typing import Iterable, Literal, NamedTuple, Optional
+
+import requests
+
+from .exceptions import NetworkError
+from .network import get_cached, session
+
+# Any mirror has the same layout, this is the origin
+DISTFILES_URL = "https://distfiles.gentoo.org/"
+AUTOBUILDS_PATH = "amd64/autobuilds/"
+DOWNLOADS_PAGE = "https://www.gentoo.org/downloads/"
+
+
+class Stage3Release(NamedTuple):
+    """
+    A stage3 tarball, paths are relative to the releases/ directory of a mirror.
+    """
+
+    path: str
+    size: Optional[int]
+    digests: str
+
+    def url(self, mirror: str = DISTFILES_URL) -> str:
+        """
+        Returns the url of the tarball on the given mirror (which ends with a /).
+        """
+        return f"{mirror}releases/{self.path}"
+
+    def digests_url(self, mirror: str = DISTFILES_URL) -> str:
+        """
+        Returns the url of the .DIGESTS file on the given mirror (which ends with a /).
+        """
+        return f"{mirror}releases/{self.digests}"
+
+
+def parse_latest(lines: Iterable[str]) -> Optional[Stage3Release]:
+    """
+    Parses a latest-stage3-*.txt file and returns the first release in it.
+    Stops reading at that release, so the PGP signature after it is never looked at.
+    The file looks like this (the PGP armor is optional):
+
+    # Latest as of Sun, 15 Oct 2023 17:02:01 +0000
+    # ts=1697389321
+    20231015T170201Z/stage3-amd64-openrc-20231015T170201Z.tar.xz 278223264
+    """
+    for line in lines:
+        line = line.strip()
+        if line.startswith("-----BEGIN PGP SIGNATURE"):
+            break
+        if not line or line.startswith(("#", "-----", "Hash:")):
+            continue
+        parts = line.split()
+        if parts[0].endswith((".tar.xz", ".tar.bz2")):
+            path = AUTOBUILDS_PATH + parts[0]
+            size = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else None
+            return Stage3Release(path, size, f"{path}.DIGESTS")
+    return None
+
+
+def latest_stage3(
+    variant: Literal["openrc", "systemd", "desktop-openrc", "desktop-systemd"]
+) -> Stage3Release:
+    """
+    Returns the latest amd64 stage3 of the given variant.
+    Falls back to scraping the gentoo.org downloads page if the index can't be read.
+    """
+    index_url = (
+        f"{DISTFILES_URL}releases/{AUTOBUILDS_PATH}latest-stage3-amd64-{variant}.txt"
+    )
+    try:
+        with session.get(index_url, stream=True) as resp:
+            resp.raise_for_status()
+            release = parse_latest(
+                line.decode("UTF-8", errors="replace") for line in resp.iter_lines()
+            )
+    except requests.RequestException:
+        release = None
+    if release is None:
+        release = _scrape_stage3(variant)
+    return release
+
+
+def _scrape_stage3(variant: str) -> Stage3Release:
+    """
+    Finds the stage3 on the gentoo.org downloads page.
+    """
+    # Only needed when the index files fail, so it isn't imported up front
+    # pylint: disable=import-outside-toplevel
+    from bs4 import BeautifulSoup  # type: ignore
+
+    downloads_soup = BeautifulSoup(get_cached(DOWNLOADS_PAGE), "html.parser")
+    download_url = downloads_soup.find(
+        "a", {"href": re.compile(fr".*stage3-amd64-{variant}-.*\.tar\.xz")}
+    )
+    if download_url is None or not download_url.get("data-relurl"):
+        raise NetworkError(f"Couldn't find the {variant} stage3")
+    path = download_url.get("data-relurl")
+    return Stage3Release(path, None, f"{path}.DIGESTS")
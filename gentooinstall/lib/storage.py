@@ -6,8 +6,6 @@ import os
 from typing import List, Literal, Optional, TypedDict
 from urllib.parse import urlparse
 
-import requests
-
 
 class Args(TypedDict):
     # pylint: disable=too-few-public-methods
@@ -17,6 +15,22 @@ class Args(TypedDict):
 
     no_ntp: bool
     no_optimal_mirror: bool
+    stream_stage3: bool
+    stage3_cache: Optional[str]
+    stage3_cache_size: int
+    profile: bool
+    format_jobs: int
+    fast_format: bool
+    btrfs_compression: int
+    no_portage_tmpfs: bool
+    march: str
+    binhost: Optional[str]
+    binpkg_cache: Optional[str]
+    distfiles_cache: Optional[str]
+    ccache: Optional[str]
+    ccache_size: int
+    zram_swap: Literal["off", "front", "instead"]
+    zram_algorithm: str
 
 
 class Storage:
@@ -26,15 +40,40 @@ class Storage:
     They can be imported from a json file for reuse.
     """
 
+    # pylint: disable=too-many-instance-attributes
+
     def __init__(self) -> None:
         """
         Initiates the Storage class
         """
-        self.args: Args = {"no_ntp": False, "no_optimal_mirror": False}
+        self.args: Args = {
+            "no_ntp": False,
+            "no_optimal_mirror": False,
+            "stream_stage3": False,
+            "stage3_cache": None,
+            "stage3_cache_size": 4,
+            "profile": False,
+            "format_jobs": 4,
+            "fast_format": False,
+            "btrfs_compression": 3,
+            "no_portage_tmpfs": False,
+            "march": "native",
+            "binhost": None,
+            "binpkg_cache": None,
+            "distfiles_cache": None,
+            "ccache": None,
+            "ccache_size": 10,
+            "zram_swap": "off",
+            "zram_algorithm": "zstd",
+        }
         self.part_scheme: Literal[0, 1, 2, 3] = 0
         self.disk: str = ""
         self.partitions: Optional[List[dict]] = []
         self.mountpoint: str = "/mnt/gentoo"
+        # Whether the disk was discarded and the mkfs options used, by partition path
+        self.formatting: dict = {"discarded": False, "options": {}}
+        # What was mounted where, see mounts.MountEntry
+        self.mounts: List[dict] = []
 
         # Internal value to see if a config has been provided or not.
         self.config = False
@@ -48,6 +87,8 @@ class Storage:
             "partScheme": self.part_scheme,
             "drives": self.partitions,
             "mountpoint": self.mountpoint,
+            "formatting": self.formatting,
+            "mounts": self.mounts,
         }
 
         # Make sure that the path specified startes with a /
@@ -64,7 +105,11 @@ class Storage:
         """
         # See if import_path is local path or a url.
         if urlparse(import_path).scheme:
-            resp = requests.get(import_path)
+            # The network stack is only needed for remote configs
+            # pylint: disable=import-outside-toplevel
+            from .network import session
+
+            resp = session.get(import_path)
             config = json.loads(resp.text)
         else:
             # Get the absolute path and decode the json
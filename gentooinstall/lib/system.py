@@ -2,16 +2,47 @@
 Module which contain classes and functions to control Gentoo
 """
 
-import random
-import re
-from typing import List, Literal
+import os
+import shutil
+import tempfile
+from typing import Dict, List, Literal, NamedTuple, Optional, Tuple
 
 import requests
-from bs4 import BeautifulSoup  # type: ignore
 from rich.progress import Progress
 
+from . import cache, download, mirrors, releases
+from .chroot import ChrootSession
 from .exceptions import NetworkError
+from .extract import extract_file, extract_stream, xz_size
 from .general import run_command
+from .mounts import MountEntry, write_fstab
+from .network import session
+
+# How many of the fastest mirrors the stage3 is downloaded from at once
+MIRROR_SOURCES = 4
+PORTAGE_TMPDIR = "/var/tmp/portage"
+# Compile jobs each package gets at least, before emerge builds several at once
+MIN_PACKAGE_JOBS = 8
+# Where portage keeps binary packages, source tarballs and the compiler cache
+PKGDIR = "/var/cache/binpkgs"
+DISTDIR = "/var/cache/distfiles"
+CCACHE_DIR = "/var/cache/ccache"
+# The official binhost, filled in with the microarchitecture level
+BINHOST_URL = "https://distfiles.gentoo.org/releases/amd64/binpackages/23.0/{}/"
+# Where packages whose build trees don't fit in memory are built instead
+NOTMPFS_DIR = "/var/tmp/notmpfs"
+# Packages known to need more room to build than the tmpfs is likely to have
+NOTMPFS_PACKAGES = [
+    "app-office/libreoffice",
+    "dev-lang/ghc",
+    "dev-lang/rust",
+    "dev-qt/qtwebengine",
+    "llvm-core/llvm",
+    "mail-client/thunderbird",
+    "net-libs/webkit-gtk",
+    "www-client/chromium",
+    "www-client/firefox",
+]
 
 
 class MakeConf:
@@ -19,12 +50,247 @@ class MakeConf:
     Represents the /etc/portage/make.conf file
     """
 
-    # pylint: disable=too-few-public-methods
+    # pylint: disable=too-many-instance-attributes
 
     def __init__(self) -> None:
         self.use: List[str] = []
         self.features = ["candy", "parallel-fetch", "parallel-install"]
         self.accept_keywords = ""
+        self.march = "native"
+        self.optimization = "-O2 -pipe"
+        self.cpu_flags_x86: List[str] = []
+        self.jobs = 1
+        self.emerge_jobs = 1
+        self.load_average = 1
+        # Any other emerge options, rendered after --jobs and --load-average
+        self.emerge_options: List[str] = []
+        # Any other variable, rendered after the ones above
+        self.variables: Dict[str, str] = {}
+
+    def tune(self, cpus: int, jobs: int, cpu_flags_x86: List[str]) -> None:
+        """
+        Sets the compile options for the machine.
+        Packages built at once times the compile jobs of each never exceeds jobs.
+        - cpus: amount of cpu threads, new jobs aren't started above this load
+        - jobs: amount of compile jobs that fit in memory, see hardware.compile_jobs()
+        - cpu_flags_x86: see hardware.cpu_flags_x86()
+        """
+        # Most packages spend a good part of their build in serial steps
+        # (configure, install), so a few are built at once to keep the cpu busy.
+        # Not when memory is what limits the jobs, one package may then use them all
+        self.emerge_jobs = 1
+        if jobs >= cpus:
+            self.emerge_jobs = max(1, jobs // MIN_PACKAGE_JOBS)
+        self.jobs = jobs // self.emerge_jobs
+        self.load_average = cpus
+        self.cpu_flags_x86 = cpu_flags_x86
+
+    def render(self) -> str:
+        """
+        Returns the contents of the file. The output only depends on the attributes.
+        """
+        lines = [
+            "# Generated by gentooinstall",
+            f'COMMON_FLAGS="-march={self.march} {self.optimization}"',
+            'CFLAGS="${COMMON_FLAGS}"',
+            'CXXFLAGS="${COMMON_FLAGS}"',
+            'FCFLAGS="${COMMON_FLAGS}"',
+            'FFLAGS="${COMMON_FLAGS}"',
+        ]
+        if self.cpu_flags_x86:
+            lines.append(f'CPU_FLAGS_X86="{" ".join(self.cpu_flags_x86)}"')
+        emerge_options = [
+            f"--jobs={self.emerge_jobs}",
+            f"--load-average={self.load_average}",
+            *self.emerge_options,
+        ]
+        lines += [
+            "",
+            f'MAKEOPTS="-j{self.jobs} -l{self.load_average}"',
+            f'EMERGE_DEFAULT_OPTS="{" ".join(emerge_options)}"',
+            f'FEATURES="{" ".join(self.features)}"',
+        ]
+        if self.use:
+            lines.append(f'USE="{" ".join(self.use)}"')
+        if self.accept_keywords:
+            lines.append(f'ACCEPT_KEYWORDS="{self.accept_keywords}"')
+        if self.variables:
+            lines.append("")
+            lines += [f'{key}="{value}"' for key, value in self.variables.items()]
+        lines += ["", "LC_MESSAGES=C.utf8"]
+        return "\n".join(lines) + "\n"
+
+    def write(self, root: str) -> None:
+        """
+        Writes the file into the system at root.
+        The old file is replaced at once, so it is never seen half written.
+        """
+        path = f"{root}/etc/portage/make.conf"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        descriptor, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path), prefix=".make.conf"
+        )
+        try:
+            with os.fdopen(descriptor, "w", encoding="UTF-8") as file:
+                file.write(self.render())
+                file.flush()
+                os.fsync(file.fileno())
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+
+def setup_portage_tmpfs(root: str, size: int) -> MountEntry:
+    """
+    Makes portage build in a tmpfs of the given size (in bytes) on the new system,
+    except for the packages in NOTMPFS_PACKAGES which are built on disk.
+    Runs once the stage3 is extracted to root.
+    Returns the fstab entry, so the install can mount the same tmpfs for its own builds.
+    """
+    # The portage user and group come with the stage3, the live system may not know them
+    uid, gid = portage_ids(root)
+    tmpfs = MountEntry(
+        "tmpfs",
+        PORTAGE_TMPDIR,
+        "tmpfs",
+        ["noatime", f"size={size // 1024**2}M", f"uid={uid}", f"gid={gid}", "mode=775"],
+    )
+    write_fstab([tmpfs], root)
+
+    os.makedirs(f"{root}{PORTAGE_TMPDIR}", exist_ok=True)
+    os.makedirs(f"{root}{NOTMPFS_DIR}", exist_ok=True)
+    os.makedirs(f"{root}/etc/portage/env", exist_ok=True)
+    with open(f"{root}/etc/portage/env/notmpfs.conf", "w", encoding="UTF-8") as file:
+        file.write(f'PORTAGE_TMPDIR="{NOTMPFS_DIR}"\n')
+    # package.env can be either a file or a directory, the stage3 doesn't ship it
+    package_env = f"{root}/etc/portage/package.env"
+    if os.path.isdir(package_env):
+        package_env = os.path.join(package_env, "notmpfs")
+    with open(package_env, "a", encoding="UTF-8") as file:
+        file.writelines(f"{package} notmpfs.conf\n" for package in NOTMPFS_PACKAGES)
+    return tmpfs
+
+
+def official_binhost(x86_64_level: int) -> str:
+    """
+    Returns the url of the official binhost with the fastest packages the cpu can run.
+    - x86_64_level: microarchitecture level of the cpu, see hardware.CpuInfo
+    """
+    # Only baseline and v3 packages are built
+    return BINHOST_URL.format("x86-64-v3" if x86_64_level >= 3 else "x86-64")
+
+
+def binhost_reachable(url: str) -> bool:
+    """
+    Checks if there's a binhost at url, by looking for its Packages index.
+    """
+    try:
+        resp = session.head(f"{url.rstrip('/')}/Packages", allow_redirects=True)
+    except requests.RequestException:
+        return False
+    return resp.ok
+
+
+def setup_binhost(root: str, url: str) -> None:
+    """
+    Adds the binhost at url to the binary package repositories of the new system.
+    """
+    section = f"[gentooinstall]\npriority = 10\nsync-uri = {url}\n"
+    # binrepos.conf can be either a file or a directory
+    path = f"{root}/etc/portage/binrepos.conf"
+    if os.path.isdir(path) or not os.path.exists(path):
+        os.makedirs(path, exist_ok=True)
+        path = os.path.join(path, "gentooinstall.conf")
+    else:
+        section = "\n" + section
+    with open(path, "a", encoding="UTF-8") as file:
+        file.write(section)
+
+
+def portage_ids(root: str) -> Tuple[int, int]:
+    """
+    Returns the uid and gid of the portage user of the system at root.
+    """
+    ids = []
+    for database in ("passwd", "group"):
+        with open(f"{root}/etc/{database}", encoding="UTF-8") as file:
+            for line in file:
+                fields = line.split(":")
+                if fields[0] == "portage":
+                    ids.append(int(fields[2]))
+                    break
+            else:
+                raise KeyError(f"There is no portage entry in /etc/{database}")
+    return ids[0], ids[1]
+
+
+def bind_cache(chroot: ChrootSession, cache_dir: str, path: str) -> None:
+    """
+    Bind mounts cache_dir (on the live system) over path in the new system,
+    so whatever this install puts in there is reused by the next one.
+    The directory is handed to the portage user, which is who fills it.
+    The mount lasts as long as chroot, it isn't left behind in the new system.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    uid, gid = portage_ids(chroot.root)
+    os.chown(cache_dir, uid, gid)
+    # Group writable, and new files stay in the portage group
+    os.chmod(cache_dir, 0o2775)
+    chroot.mount("--bind", cache_dir, target=path)
+
+
+def setup_ccache(cache_dir: str, size: int) -> None:
+    """
+    Configures the ccache directory on the live system to hold up to size bytes.
+    The statistics are zeroed, so ccache_stats() only counts this install.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, "ccache.conf"), "w", encoding="UTF-8") as file:
+        file.write(
+            f"max_size = {size // 1024**2}M\n"
+            # Packages are built in a different directory every time
+            "hash_dir = false\n"
+            "umask = 002\n"
+            # Hashing the compiler binary is slow, its version is enough
+            "compiler_check = %compiler% -dumpversion\n"
+        )
+    if shutil.which("ccache"):
+        run_command(["ccache", "--dir", cache_dir, "--zero-stats"])
+
+
+def ccache_stats(cache_dir: str) -> Optional[Tuple[int, int]]:
+    """
+    Returns the amount of cache hits and misses since setup_ccache(),
+    None if ccache isn't installed on the live system.
+    """
+    if not shutil.which("ccache"):
+        return None
+    output = str(run_command(["ccache", "--dir", cache_dir, "--print-stats"], True))
+    counters = {}
+    for line in output.splitlines():
+        key, _, value = line.partition("\t")
+        if value.strip().isdigit():
+            counters[key] = int(value)
+    hits = counters.get("direct_cache_hit", 0) + counters.get(
+        "preprocessed_cache_hit", 0
+    )
+    return hits, counters.get("cache_miss", 0)
+
+
+class Stage3Options(NamedTuple):
+    """
+    How the stage3 tarball gets from the mirror to the disk.
+    - stream: extract while downloading, without writing the tarball to disk
+    - cache_dir: directory of verified tarballs to reuse between installs,
+      when set the tarball is always verified before it is extracted
+    - cache_size: upper bound (in bytes) of the cache
+    """
+
+    stream: bool = False
+    cache_dir: Optional[str] = None
+    cache_size: int = cache.DEFAULT_MAX_SIZE
 
 
 # Weirdly, pylint thinks str has been redfined.
@@ -33,103 +299,114 @@ def install_stage3(
     type: Literal["openrc", "systemd", "desktop-openrc", "desktop-systemd"],
     path: str = "/mnt/gentoo/stage3.tar.xz",
     optimal_mirror: bool = True,
+    connections: int = 8,
+    options: Optional[Stage3Options] = None,
 ) -> None:
     """
     Downloads an amd64 stage3 tarball into the path parameter.
-    Then unpacks it using a tar command.
+    Then unpacks it in-process with extract.Extractor, xz decompressing alongside.
     And finally, deletes the tarball.
+    See Stage3Options for unpacking it as it downloads, or through a cache, instead.
 
     - type: Kind of stage3 tarball to download
     - path: optional absolute path,
-    - optimal_mirror: optional use of 3rd party api to find geolocation
+    - optimal_mirror: optionally measure the mirrors and download from the fastest one
+    - connections: optional amount of concurrent connections used for the download
+    - options: optional Stage3Options
     """
     # pylint: disable=too-many-locals,invalid-name,too-many-branches,too-many-statements
+    options = options or Stage3Options()
     with Progress(expand=True) as progress:
-        downloads_page = requests.get("https://www.gentoo.org/downloads/")
-        downloads_soup = BeautifulSoup(downloads_page.text, "html.parser")
-        download_url = downloads_soup.find(
-            "a", {"href": re.compile(fr".*stage3-amd64-{type}-.*\.tar\.xz")}
-        )
-        final_url = download_url.get("href")
-
+        release = releases.latest_stage3(type)
+        # The origin, unless the mirrors are measured
+        bases = [releases.DISTFILES_URL]
         if optimal_mirror:
-            # Get IP Geolocation
-            finding_mirror = progress.add_task("[yellow]Finding optimal mirror...")
-            ip = requests.get("https://api.ipify.org").text
-            progress.advance(finding_mirror, 10)
-
-            continent_code = requests.get(
-                f"http://ip-api.com/json/{ip}?fields=status,message,continentCode"
-            ).json()["continentCode"]
-            progress.advance(finding_mirror, 10)
-
-            if continent_code == "AF":
-                continent = "Africa"
-            elif continent_code == "AS":
-                continent = "Asia"
-            elif continent_code == "EU":
-                continent = "Europe"
-            elif continent_code == "NA":
-                continent = "North America"
-            elif continent_code == "SA":
-                continent = "South America"
-            elif continent_code == "OC":
-                continent = "Australia and Oceania"
-            else:
-                raise NetworkError("API Error")
-            # Use the continent to get a random download link
-            mirrors_page = requests.get("https://www.gentoo.org/downloads/mirrors/")
-            mirrors_soup = BeautifulSoup(mirrors_page.text, "html.parser")
-            progress.advance(finding_mirror, 30)
-            mirrors_url = (
-                mirrors_soup.find("h2", string=continent)
-                .find_next("table")
-                .find_all("a", attrs={"href": re.compile(r"http.*://.*")})
+            # Measure the mirrors and download from the fastest ones
+            finding_mirror = progress.add_task(
+                "[yellow]Finding optimal mirror...", start=False
             )
-            progress.advance(finding_mirror, 30)
+            ranking = mirrors.ranked_mirrors()
+            if not ranking:
+                raise NetworkError("None of the mirrors could be reached")
+            bases = [mirror.url for mirror in ranking[:MIRROR_SOURCES]]
+            progress.start_task(finding_mirror)
+            progress.advance(finding_mirror, 100)
 
-            # Do some link black magic
-            chosen_mirror_url: str = random.choice(mirrors_url).get("href")
-            if chosen_mirror_url.endswith("/"):
-                final_url = (
-                    chosen_mirror_url + "releases/" + download_url.get("data-relurl")
+        # Each of them is tried in turn, should the first one fail
+        stage3_urls = [release.url(base) for base in bases]
+        extract_to = "/".join(path.split("/")[:-1])
+        if options.cache_dir is not None:
+            # Verify the tarball against the published SHA512 and keep it for next time
+            stage3_cache = cache.Stage3Cache(options.cache_dir, options.cache_size)
+            # The origin's digests are preferred, the mirrors only stand in for it
+            digests_urls = [
+                release.digests_url(base)
+                for base in dict.fromkeys([releases.DISTFILES_URL, *bases])
+            ]
+            digest = cache.published_digest(stage3_urls[0], digests_urls)
+            cached_path = stage3_cache.lookup(digest)
+            if cached_path is None:
+                download_stage3 = progress.add_task(
+                    "[yellow]Downloading stage3 tarball into the cache...", total=0
                 )
-            else:
-                final_url = (
-                    chosen_mirror_url + "/releases/" + download_url.get("data-relurl")
+                cached_path = stage3_cache.fill(
+                    stage3_urls,
+                    digest,
+                    lambda length: progress.advance(download_stage3, length),
+                    lambda length: progress.update(download_stage3, total=length),
                 )
-            progress.advance(finding_mirror, 20)
-
-        # Download the file from the link (writing bytes basically)
-        with open(path, "wb") as f:
-            resp = requests.get(final_url, stream=True)
-            content_length_header = resp.headers.get("content-length")
-            if isinstance(content_length_header, str):
-                content_length = int(content_length_header)
-            else:
-                raise NetworkError(f"No content-length from: {final_url}")
+            _extract_with_progress(progress, cached_path, extract_to)
+            return
+
+        if options.stream:
+            # Pipe the download straight into tar
             download_stage3 = progress.add_task(
-                "[yellow]Downloading stage3 tarball...", total_length=100
+                "[yellow]Downloading and extracting stage3...", total=0
             )
-            download_length = 0
-            for chunk in resp.iter_content(chunk_size=1024):
-                if chunk:
-                    download_length += len(chunk)
-                    f.write(chunk)
-                    progress.update(
-                        download_stage3,
-                        completed=int(100 * download_length / content_length),
-                    )
+            extract_stream(
+                download.stream(
+                    stage3_urls[0],
+                    lambda length: progress.advance(download_stage3, length),
+                    lambda length: progress.update(download_stage3, total=length),
+                    stage3_urls[1:],
+                ),
+                extract_to,
+            )
+            return
 
-        # Extract the tar file to the specified path
-        extracting_stage3 = progress.add_task(
-            "[yellow]Extracting stage3...", start=False
+        # Download the file from the link (and the other mirrors) over several connections
+        stage3 = download.SegmentedDownload(
+            stage3_urls[0], path, connections, stage3_urls[1:]
         )
-        extract_to = "/".join(path.split("/")[:-1])
-        run_command(
-            f"tar xpvf {path} --xattrs-include='*.*' --numeric-owner -C {extract_to}"
+        stage3.prepare()
+        # Without a content-length the bar just pulses until the download is done
+        download_stage3 = progress.add_task(
+            "[yellow]Downloading stage3 tarball...",
+            start=stage3.total_length is not None,
+            total=stage3.total_length or 0,
+            completed=stage3.completed,
         )
+        stage3.run(lambda length: progress.advance(download_stage3, length))
+        if stage3.total_length is None:
+            progress.start_task(download_stage3)
+            progress.update(download_stage3, total=1, completed=1)
+
+        # Extract the tar file to the specified path
+        _extract_with_progress(progress, path, extract_to)
         # Delete the stage3 tar file to save space
-        run_command(f"rm -rf {path}")
-        progress.start_task(extracting_stage3)
-        progress.advance(extracting_stage3, 100)
+        run_command(["rm", "-rf", path])
+
+
+def _extract_with_progress(progress: Progress, path: str, dest: str) -> None:
+    """
+    Unpacks the tarball at path into dest, with a bar of the bytes written so far.
+    Without a known uncompressed size the bar just pulses until it is done.
+    """
+    size = xz_size(path)
+    extracting_stage3 = progress.add_task(
+        "[yellow]Extracting stage3...", start=size is not None, total=size or 0
+    )
+    extract_file(path, dest, lambda length: progress.advance(extracting_stage3, length))
+    # The tar headers aren't counted, fill the bar up
+    progress.start_task(extracting_stage3)
+    progress.update(extracting_stage3, total=size or 1, completed=size or 1)
@@ -0,0 +1,82 @@
+"""
+This module sets up compressed swap in memory (zram),
+both for the live system during the install and for the installed system.
+"""
+import os
+from typing import Literal
+
+from .general import run_command
+
+# Swap with a higher priority is used first, disk swap defaults to a negative one
+PRIORITY = 100
+SYSTEMD_CONFIG = "/etc/systemd/zram-generator.conf"
+OPENRC_SCRIPT = "/etc/local.d/zram-swap"
+
+
+def activate(size: int, algorithm: str = "zstd") -> str:
+    """
+    Creates a zram device of size bytes and swaps to it, in front of any disk swap.
+    Returns the path of the device.
+    """
+    run_command(["modprobe", "zram"])
+    device = str(
+        run_command(
+            [
+                "zramctl",
+                "--find",
+                "--size",
+                f"{size // 1024**2}M",
+                "--algorithm",
+                algorithm,
+            ],
+            True,
+        )
+    ).strip()
+    run_command(["mkswap", device])
+    run_command(["swapon", "--priority", str(PRIORITY), device])
+    return device
+
+
+def persist(
+    root: str, size: int, algorithm: str, init: Literal["openrc", "systemd"]
+) -> None:
+    """
+    Makes the installed system at root set up the same zram swap on every boot.
+    systemd uses zram-generator (sys-apps/zram-generator, which has to be emerged),
+    OpenRC uses a script of the local service, which is in the default runlevel.
+    """
+    if init == "systemd":
+        os.makedirs(os.path.dirname(f"{root}{SYSTEMD_CONFIG}"), exist_ok=True)
+        with open(f"{root}{SYSTEMD_CONFIG}", "w", encoding="UTF-8") as file:
+            file.write(
+                "[zram0]\n"
+                f"zram-size = {size // 1024**2}\n"
+                f"compression-algorithm = {algorithm}\n"
+                f"swap-priority = {PRIORITY}\n"
+            )
+        return
+
+    os.makedirs(os.path.dirname(f"{root}{OPENRC_SCRIPT}"), exist_ok=True)
+    scripts = {
+        ".start": (
+            "modprobe zram\n"
+            f"device=$(zramctl --find --size {size // 1024**2}M"
+            f" --algorithm {algorithm})\n"
+            'mkswap "$device" >/dev/null\n'
+            f'swapon --priority {PRIORITY} "$device"\n'
+            # Remembered so .stop only removes this device
+            'echo "$device" > /run/zram-swap\n'
+        ),
+        ".stop": (
+            "[ -f /run/zram-swap ] || exit 0\n"
+            "device=$(cat /run/zram-swap)\n"
+            'swapoff "$device"\n'
+            'zramctl --reset "$device"\n'
+            "rm /run/zram-swap\n"
+        ),
+    }
+    for suffix, body in scripts.items():
+        path = f"{root}{OPENRC_SCRIPT}{suffix}"
+        with open(path, "w", encoding="UTF-8") as file:
+            file.write("#!/bin/sh\n# Added by gentooinstall\n" + body)
+        os.chmod(path, 0o755)
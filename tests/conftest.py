@@ -0,0 +1,112 @@
+"""
+Local HTTP servers standing in for Gentoo mirrors and binhosts.
+"""
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+
+class Mirror:
+    """
+    Serves files from memory on a random local port.
+    - ranges: answer Range requests with 206, and advertise it
+    - status: answer every request with this status instead
+    - truncate: amount of GET requests whose body is cut in half
+    - delay: seconds to wait between the headers and the body of a GET
+    """
+
+    def __init__(self, files, ranges=True, status=200, truncate=0, delay=0.0):
+        self.files = files
+        self.ranges = ranges
+        self.status = status
+        self.truncate = truncate
+        self.delay = delay
+        self.served = 0
+        self.requests = []
+        self._lock = threading.Lock()
+        mirror = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_HEAD(self):
+                mirror.respond(self, body=False)
+
+            def do_GET(self):
+                mirror.respond(self, body=True)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        # A client hanging up on a stalled or cut response isn't worth a traceback
+        self.server.handle_error = lambda request, address: None
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def respond(self, handler, body):
+        """
+        Answers one request.
+        """
+        with self._lock:
+            self.requests.append((handler.command, handler.path, dict(handler.headers)))
+        data = self.files.get(handler.path)
+        status = self.status if data is not None else 404
+        if status != 200:
+            handler.send_response(status)
+            handler.send_header("Content-Length", "0")
+            handler.end_headers()
+            return
+
+        start, end = 0, len(data)
+        if self.ranges and "Range" in handler.headers:
+            first, last = handler.headers["Range"].removeprefix("bytes=").split("-")
+            start, end = int(first), int(last or len(data) - 1) + 1
+            handler.send_response(206)
+            handler.send_header("Content-Range", f"bytes {start}-{end - 1}/{len(data)}")
+        else:
+            handler.send_response(200)
+        if self.ranges:
+            handler.send_header("Accept-Ranges", "bytes")
+        handler.send_header("Content-Length", str(end - start))
+        handler.end_headers()
+        if not body:
+            return
+
+        payload = data[start:end]
+        with self._lock:
+            cut = self.truncate > 0
+            self.truncate -= cut
+        if cut:
+            payload = payload[: len(payload) // 2]
+            handler.close_connection = True
+        time.sleep(self.delay)
+        handler.wfile.write(payload)
+        with self._lock:
+            self.served += len(payload)
+
+    def close(self):
+        """
+        Stops serving.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def mirror():
+    """
+    Returns a function starting a Mirror, which is stopped after the test.
+    """
+    started = []
+
+    def start(files, **kwargs):
+        started.append(Mirror(files, **kwargs))
+        return started[-1]
+
+    yield start
+    for server in started:
+        server.close()
@@ -0,0 +1,65 @@
+"""
+Tests for the make.conf and binrepos.conf written for a binhost and a binpkg cache.
+"""
+import pytest
+
+from gentooinstall.lib import installer, system
+from gentooinstall.lib.chroot import ChrootSession
+from gentooinstall.lib.hardware import Hardware
+from gentooinstall.lib.storage import storage
+
+from .test_make_conf import CPUINFO, MEMINFO
+
+
+@pytest.fixture
+def root(tmp_path, monkeypatch):
+    (tmp_path / "cpuinfo").write_text(CPUINFO)
+    (tmp_path / "meminfo").write_text(MEMINFO)
+    monkeypatch.setattr(
+        installer, "hardware", Hardware(tmp_path / "cpuinfo", tmp_path / "meminfo")
+    )
+    monkeypatch.setattr(storage, "mountpoint", str(tmp_path / "root"))
+    monkeypatch.setitem(storage.args, "no_portage_tmpfs", True)
+    return tmp_path / "root"
+
+
+def make_conf(root):
+    variables = {}
+    for line in (root / "etc/portage/make.conf").read_text().splitlines():
+        key, _, value = line.partition("=")
+        variables[key] = value.strip('"')
+    return variables
+
+
+def test_reachable_binhost(mirror, root, monkeypatch):
+    binhost = mirror({"/Packages": b"PACKAGES: 0\n"})
+    monkeypatch.setitem(storage.args, "binhost", f"{binhost.url}/")
+    installer.configure_make_conf(ChrootSession(str(root)))
+
+    assert "getbinpkg" in make_conf(root)["FEATURES"].split()
+    assert (root / "etc/portage/binrepos.conf/gentooinstall.conf").read_text() == (
+        f"[gentooinstall]\npriority = 10\nsync-uri = {binhost.url}/\n"
+    )
+
+
+def test_unreachable_binhost(mirror, root, monkeypatch):
+    binhost = mirror({})
+    monkeypatch.setitem(storage.args, "binhost", f"{binhost.url}/")
+    installer.configure_make_conf(ChrootSession(str(root)))
+
+    assert "getbinpkg" not in make_conf(root)["FEATURES"].split()
+    assert not (root / "etc/portage/binrepos.conf").exists()
+
+
+def test_binpkg_cache_is_read_back(root, tmp_path, monkeypatch):
+    mounted = []
+    monkeypatch.setattr(system, "bind_cache", lambda *args: mounted.append(args))
+    monkeypatch.setitem(storage.args, "binpkg_cache", str(tmp_path / "binpkgs"))
+    installer.configure_make_conf(ChrootSession(str(root)))
+
+    variables = make_conf(root)
+    assert "buildpkg" in variables["FEATURES"].split()
+    assert "--usepkg" in variables["EMERGE_DEFAULT_OPTS"].split()
+    assert [args[1:] for args in mounted] == [
+        (str(tmp_path / "binpkgs"), system.PKGDIR)
+    ]
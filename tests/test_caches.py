@@ -0,0 +1,33 @@
+"""
+Tests for the cache directories shared with the new system.
+"""
+import os
+
+from gentooinstall.lib import chroot, system
+from gentooinstall.lib.chroot import ChrootSession
+
+
+def test_cache_mounts_end_with_the_session(tmp_path, monkeypatch):
+    commands = []
+    monkeypatch.setattr(chroot, "run_command", commands.append)
+    root = tmp_path / "root"
+    (root / "etc").mkdir(parents=True)
+    # The current user stands in for portage, so the cache can be handed to it
+    (root / "etc/passwd").write_text(f"portage:x:{os.getuid()}:{os.getgid()}::/:\n")
+    (root / "etc/group").write_text(f"portage:x:{os.getgid()}:\n")
+
+    session = ChrootSession(str(root))
+    system.bind_cache(session, str(tmp_path / "distfiles"), system.DISTDIR)
+    system.bind_cache(session, str(tmp_path / "ccache"), system.CCACHE_DIR)
+    assert commands == [
+        ["mount", "--bind", str(tmp_path / "distfiles"), f"{root}{system.DISTDIR}"],
+        ["mount", "--bind", str(tmp_path / "ccache"), f"{root}{system.CCACHE_DIR}"],
+    ]
+
+    commands.clear()
+    session.close()
+    assert commands == [
+        ["umount", "--lazy", "--recursive", f"{root}{system.CCACHE_DIR}"],
+        ["umount", "--lazy", "--recursive", f"{root}{system.DISTDIR}"],
+    ]
+    assert oct(os.stat(tmp_path / "ccache").st_mode & 0o7777) == "0o2775"
@@ -0,0 +1,40 @@
+"""
+Tests for the shell of ChrootSession, run without chrooting.
+"""
+import subprocess
+import time
+
+from gentooinstall.lib import chroot
+from gentooinstall.lib.chroot import ChrootSession
+
+
+def running(pid):
+    try:
+        with open(f"/proc/{pid}/stat", encoding="UTF-8") as file:
+            # The state comes after the command name, which is in parentheses
+            return file.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+def test_close_kills_what_the_shell_started(tmp_path, monkeypatch):
+    monkeypatch.setattr(chroot, "EXIT_TIMEOUT", 0.5)
+    session = ChrootSession(str(tmp_path))
+    # Started the way open() starts it, minus the chroot
+    session._shell = subprocess.Popen(
+        ["bash", "--noprofile", "--norc"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        start_new_session=True,
+    )
+    assert session.run("echo hello") == "hello\n"
+    # Like an emerge left behind by an interrupted command
+    pid = int(session.run("sleep 60 & echo $!"))
+    assert running(pid)
+
+    session.close()
+    deadline = time.monotonic() + 5
+    while running(pid) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not running(pid)
@@ -0,0 +1,43 @@
+"""
+Tests for the mkfs and mount options picked from a disk's traits.
+"""
+import pytest
+
+from gentooinstall.lib.disks import DiskTraits, mkfs_options
+from gentooinstall.lib.mounts import btrfs_options
+
+
+def traits(minimum_io_size, optimal_io_size, transport="ata"):
+    return DiskTraits(
+        False, 512, 2147450880, minimum_io_size, optimal_io_size, transport
+    )
+
+
+@pytest.mark.parametrize(
+    "minimum_io_size, optimal_io_size",
+    [(512, 4096), (512, 1048576), (4096, 6144), (0, 0), (4096, 4096)],
+)
+def test_no_stripe_hints_without_whole_blocks(minimum_io_size, optimal_io_size):
+    disk = traits(minimum_io_size, optimal_io_size)
+    assert mkfs_options("xfs", disk, False) == []
+    assert mkfs_options("ext4", disk, False) == [
+        "-E",
+        "lazy_itable_init=1,lazy_journal_init=1",
+    ]
+
+
+def test_stripe_hints():
+    disk = traits(8192, 65536)
+    assert mkfs_options("xfs", disk, True) == ["-K", "-d", "su=8192,sw=8"]
+    assert mkfs_options("ext4", disk, True) == [
+        "-E",
+        "lazy_itable_init=1,lazy_journal_init=1,nodiscard,stride=2,stripe_width=16",
+    ]
+
+
+@pytest.mark.parametrize(
+    "transport, discard",
+    [("nvme", "discard=async"), ("virtio", "discard=async"), ("ata", "nodiscard")],
+)
+def test_btrfs_discard_follows_the_transport(transport, discard):
+    assert btrfs_options(traits(512, 0, transport), 0) == ["noatime", "ssd", discard]
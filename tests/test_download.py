@@ -0,0 +1,149 @@
+"""
+Tests for the download engine against local mirrors.
+"""
+import errno
+import json
+import os
+import random
+
+import pytest
+
+from gentooinstall.lib import download
+from gentooinstall.lib.download import SegmentedDownload
+
+PATH = "/stage3.tar.xz"
+PIECE_SIZE = 256 * 1024
+DATA = random.Random(0).randbytes(5 * PIECE_SIZE + 1234)
+
+
+@pytest.fixture(autouse=True)
+def small_pieces(monkeypatch):
+    monkeypatch.setattr(download, "PIECE_SIZE", PIECE_SIZE)
+    monkeypatch.setattr(download, "CHUNK_SIZE", 64 * 1024)
+
+
+def fetch(url, path, mirrors=None, connections=4):
+    job = SegmentedDownload(url, str(path), connections, mirrors)
+    job.prepare()
+    job.run()
+    return job
+
+
+def test_ranged_download(mirror, tmp_path):
+    server = mirror({PATH: DATA})
+    job = fetch(server.url + PATH, tmp_path / "stage3")
+    assert job.ranged
+    assert (tmp_path / "stage3").read_bytes() == DATA
+    assert not os.path.exists(job.state_path)
+    ranges = [headers.get("Range") for command, _, headers in server.requests]
+    assert ranges.count(None) == 1  # Only HEAD asks for the whole file
+    assert server.served == len(DATA)
+
+
+def test_single_stream_without_ranges(mirror, tmp_path):
+    server = mirror({PATH: DATA}, ranges=False)
+    job = fetch(server.url + PATH, tmp_path / "stage3")
+    assert not job.ranged
+    assert (tmp_path / "stage3").read_bytes() == DATA
+
+
+def test_bodies_are_not_encoded(mirror, tmp_path):
+    ranged = mirror({PATH: DATA})
+    single = mirror({PATH: DATA}, ranges=False)
+    fetch(ranged.url + PATH, tmp_path / "ranged")
+    fetch(single.url + PATH, tmp_path / "single")
+    b"".join(download.stream(single.url + PATH))
+    for command, _, headers in ranged.requests + single.requests:
+        if command == "GET":
+            assert headers["Accept-Encoding"] == "identity"
+
+
+def test_failed_write_keeps_state_and_resumes(mirror, tmp_path, monkeypatch):
+    server = mirror({PATH: DATA})
+    writes = []
+    pwrite = os.pwrite
+
+    def failing_pwrite(descriptor, data, offset):
+        writes.append(offset)
+        if len(writes) > 6:
+            raise OSError(errno.ENOSPC, "No space left on device")
+        return pwrite(descriptor, data, offset)
+
+    monkeypatch.setattr(os, "pwrite", failing_pwrite)
+    with pytest.raises(OSError):
+        fetch(server.url + PATH, tmp_path / "stage3")
+    monkeypatch.setattr(os, "pwrite", pwrite)
+
+    state_path = tmp_path / "stage3.parts"
+    with open(state_path, encoding="UTF-8") as file:
+        saved = sum(written for _, _, written in json.load(file)["segments"])
+    assert 0 < saved < len(DATA)
+
+    served = server.served
+    fetch(server.url + PATH, tmp_path / "stage3")
+    assert (tmp_path / "stage3").read_bytes() == DATA
+    assert not state_path.exists()
+    assert server.served - served == len(DATA) - saved
+
+
+def test_unfinished_download_keeps_state(mirror, tmp_path, monkeypatch):
+    server = mirror({PATH: DATA})
+    job = SegmentedDownload(server.url + PATH, str(tmp_path / "stage3"), 2)
+    job.prepare()
+    # A worker that gives up without an error mustn't pass for a finished download
+    monkeypatch.setattr(job, "_worker", lambda preferred, advance: None)
+    with pytest.raises(download.NetworkError):
+        job.run()
+    assert os.path.exists(job.state_path)
+
+
+def test_dead_primary_is_skipped(mirror, tmp_path):
+    dead = mirror({})
+    server = mirror({PATH: DATA})
+    job = fetch(dead.url + PATH, tmp_path / "stage3", [server.url + PATH])
+    assert job.url == server.url + PATH
+    assert (tmp_path / "stage3").read_bytes() == DATA
+    assert all(command == "HEAD" for command, _, _ in dead.requests)
+
+
+def test_every_mirror_dead(mirror, tmp_path):
+    dead = mirror({})
+    with pytest.raises(download.NetworkError):
+        fetch(dead.url + PATH, tmp_path / "stage3", [mirror({}).url + PATH])
+
+
+def test_flaky_mirror_is_demoted(mirror, tmp_path):
+    flaky = mirror({PATH: DATA}, truncate=100)
+    server = mirror({PATH: DATA})
+    job = fetch(flaky.url + PATH, tmp_path / "stage3", [server.url + PATH])
+    assert (tmp_path / "stage3").read_bytes() == DATA
+    assert job.sources[0].demoted
+    assert not job.sources[1].demoted
+
+
+def test_stalled_mirror_is_demoted(mirror, tmp_path, monkeypatch):
+    monkeypatch.setattr(download, "TIMEOUT", 0.5)
+    stalled = mirror({PATH: DATA}, delay=5)
+    server = mirror({PATH: DATA})
+    job = fetch(stalled.url + PATH, tmp_path / "stage3", [server.url + PATH])
+    assert (tmp_path / "stage3").read_bytes() == DATA
+    assert job.sources[0].demoted
+
+
+def test_stream_carries_on_from_the_next_mirror(mirror):
+    flaky = mirror({PATH: DATA}, truncate=1)
+    server = mirror({PATH: DATA})
+    lengths = []
+    body = b"".join(
+        download.stream(flaky.url + PATH, None, lengths.append, [server.url + PATH])
+    )
+    assert body == DATA
+    assert lengths[0] == len(DATA)
+    # The second mirror only sends what the first one didn't
+    assert server.served < len(DATA)
+    assert server.requests[0][2]["Range"] != "bytes=0-"
+
+
+def test_stream_fails_once_every_mirror_did(mirror):
+    with pytest.raises(download.NetworkError):
+        b"".join(download.stream(mirror({}).url + PATH, None, None, []))
@@ -0,0 +1,54 @@
+"""
+Tests for the command engine.
+"""
+import sys
+
+import pytest
+
+from gentooinstall.lib import execution
+from gentooinstall.lib.exceptions import CommandError
+from gentooinstall.lib.execution import Engine, RunOptions
+
+
+@pytest.fixture
+def engine():
+    engine = Engine()
+    yield engine
+    engine.close()
+
+
+def python(code):
+    return [sys.executable, "-X", "utf8", "-c", code]
+
+
+# A character of three bytes doesn't fit evenly in a piece
+@pytest.mark.parametrize("character", ["x", "\u20ac"])
+def test_over_long_lines_come_in_pieces(engine, character):
+    size = 3 * execution.LINE_LIMIT + 5
+    lines = []
+    result = engine.run(
+        python(f"print({character!r} * {size}); print('done')"),
+        RunOptions(on_stdout=lines.append, capture=True),
+    )
+    assert result.stdout == character * size + "\ndone\n"
+    assert lines[-1] == "done"
+    assert "".join(lines[:-1]) == character * size
+    assert all(len(line) <= execution.LINE_LIMIT for line in lines)
+
+
+def test_last_line_without_newline(engine):
+    result = engine.run(python("print('last', end='')"), RunOptions(capture=True))
+    assert result.stdout == "last"
+
+
+def test_failed_callback_is_a_command_error(engine):
+    def callback(line):
+        raise RuntimeError(line)
+
+    with pytest.raises(CommandError) as error:
+        engine.run(
+            python("import time; print('hello', flush=True); time.sleep(60)"),
+            RunOptions(on_stdout=callback),
+        )
+    assert isinstance(error.value.__cause__, RuntimeError)
+    assert error.value.output == "hello\n"
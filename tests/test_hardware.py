@@ -0,0 +1,109 @@
+"""
+Tests for the sizes derived from synthetic /proc/cpuinfo and /proc/meminfo files.
+"""
+import pytest
+
+from gentooinstall.lib import hardware
+from gentooinstall.lib.hardware import (
+    BUILD_JOB_MEMORY,
+    MEMORY_RESERVE,
+    MIN_PORTAGE_TMPFS,
+    CpuInfo,
+    Hardware,
+    MemInfo,
+)
+
+GIB = 1024 ** 3
+CPUINFO = """\
+processor\t: {processor}
+vendor_id\t: GenuineIntel
+model name\t: Synthetic CPU
+physical id\t: 0
+core id\t\t: {core}
+flags\t\t: fpu sse sse2 pni ssse3 sse4_1 sse4_2 popcnt cx16 lahf_lm avx avx2
+
+"""
+
+
+def write_cpuinfo(tmp_path, threads):
+    path = tmp_path / "cpuinfo"
+    path.write_text(
+        "".join(
+            CPUINFO.format(processor=thread, core=thread // 2)
+            for thread in range(threads)
+        )
+    )
+    return path
+
+
+def write_meminfo(tmp_path, total_gib, available_gib=None):
+    path = tmp_path / "meminfo"
+    lines = [f"MemTotal:       {total_gib * 1024 * 1024} kB"]
+    lines.append("MemFree:         1024 kB")
+    if available_gib is not None:
+        lines.append(f"MemAvailable:   {available_gib * 1024 * 1024} kB")
+    path.write_text("\n".join(lines) + "\n")
+    return path
+
+
+def test_meminfo(tmp_path):
+    meminfo = MemInfo(write_meminfo(tmp_path, 16, 12))
+    assert meminfo.total == 16 * GIB
+    assert meminfo.available == 12 * GIB
+    # Older kernels don't have MemAvailable
+    assert MemInfo(write_meminfo(tmp_path, 4)).available == 4 * GIB
+
+
+def test_cpuinfo(tmp_path):
+    cpuinfo = CpuInfo(write_cpuinfo(tmp_path, 8))
+    assert cpuinfo.threads == 8
+    assert cpuinfo.cores == 4
+    assert cpuinfo.vendor == "GenuineIntel"
+    assert "avx2" in cpuinfo.flags
+
+
+@pytest.mark.parametrize(
+    "total_gib, threads, tmpfs_gib, jobs",
+    [
+        # Too little memory for a tmpfs, the jobs get all of it
+        (4, 8, 0, 2),
+        (8, 16, 0, 4),
+        # Memory bound: a quarter of what the system leaves goes to the tmpfs,
+        # the jobs share the rest
+        (16, 16, 3.5, 5),
+        (32, 16, 7.5, 11),
+        # Cpu bound: the tmpfs doesn't cost a job
+        (64, 16, 15.5, 16),
+        (32, 4, 7.5, 4),
+    ],
+)
+def test_tmpfs_and_jobs(tmp_path, total_gib, threads, tmpfs_gib, jobs):
+    machine = Hardware(
+        write_cpuinfo(tmp_path, threads), write_meminfo(tmp_path, total_gib)
+    )
+    tmpfs = machine.portage_tmpfs_size()
+    assert tmpfs == int(tmpfs_gib * GIB)
+    assert machine.compile_jobs(tmpfs) == jobs
+
+
+def test_jobs_without_tmpfs(tmp_path):
+    machine = Hardware(write_cpuinfo(tmp_path, 16), write_meminfo(tmp_path, 16))
+    assert machine.compile_jobs() == 8
+
+
+@pytest.mark.parametrize("total_gib", [2, 4, 8, 12, 16, 24, 32, 48, 64, 128])
+@pytest.mark.parametrize("threads", [1, 2, 4, 8, 16, 32, 64])
+def test_tmpfs_leaves_room_for_the_jobs(total_gib, threads):
+    total_mem = total_gib * 1024 * 1024
+    tmpfs = hardware.portage_tmpfs_size(total_mem)
+    jobs = hardware.compile_jobs(total_mem, threads, tmpfs)
+    if tmpfs:
+        assert tmpfs + jobs * BUILD_JOB_MEMORY + MEMORY_RESERVE <= total_gib * GIB
+    # The tmpfs is only worth it with room for a build in it
+    assert tmpfs == 0 or tmpfs >= MIN_PORTAGE_TMPFS
+
+
+def test_zram_swap_size(tmp_path):
+    assert Hardware(meminfo=write_meminfo(tmp_path, 8)).zram_swap_size() == 4 * GIB
+    # Capped, compressed pages still take up memory
+    assert Hardware(meminfo=write_meminfo(tmp_path, 128)).zram_swap_size() == 16 * GIB
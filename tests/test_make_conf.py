@@ -0,0 +1,71 @@
+"""
+Golden file tests for the make.conf rendered from a fixed machine.
+"""
+from pathlib import Path
+
+import pytest
+
+from gentooinstall.lib.hardware import Hardware, compile_jobs
+from gentooinstall.lib.system import MakeConf
+
+GOLDEN = Path(__file__).parent / "golden"
+# A 16 thread x86-64-v3 machine with 32 GiB of memory
+CPUINFO = "".join(
+    f"processor\t: {thread}\n"
+    "vendor_id\t: AuthenticAMD\n"
+    "physical id\t: 0\n"
+    f"core id\t\t: {thread // 2}\n"
+    "flags\t\t: fpu mmx sse sse2 pni pclmulqdq ssse3 fma cx16 sse4_1 sse4_2 movbe "
+    "popcnt aes xsave avx f16c rdrand lahf_lm abm sse4a bmi1 avx2 bmi2 sha_ni\n\n"
+    for thread in range(16)
+)
+MEMINFO = "MemTotal:       33554432 kB\nMemAvailable:   30000000 kB\n"
+
+
+def machine(tmp_path):
+    (tmp_path / "cpuinfo").write_text(CPUINFO)
+    (tmp_path / "meminfo").write_text(MEMINFO)
+    return Hardware(tmp_path / "cpuinfo", tmp_path / "meminfo")
+
+
+def test_tuned_make_conf(tmp_path):
+    hardware = machine(tmp_path)
+    make_conf = MakeConf()
+    make_conf.tune(hardware.cpus, hardware.compile_jobs(), hardware.cpu_flags_x86())
+    assert make_conf.render() == (GOLDEN / "make.conf").read_text()
+
+
+def test_make_conf_with_caches(tmp_path):
+    hardware = machine(tmp_path)
+    make_conf = MakeConf()
+    make_conf.march = "x86-64-v3"
+    make_conf.tune(hardware.cpus, hardware.compile_jobs(), [])
+    make_conf.features += ["getbinpkg", "buildpkg", "ccache"]
+    make_conf.emerge_options.append("--usepkg")
+    make_conf.variables["CCACHE_DIR"] = "/var/cache/ccache"
+    make_conf.variables["CCACHE_SIZE"] = "10G"
+    assert make_conf.render() == (GOLDEN / "make.conf.caches").read_text()
+
+
+@pytest.mark.parametrize("total_gib", [2, 4, 8, 16, 32, 64, 128, 256])
+@pytest.mark.parametrize("threads", [1, 2, 4, 8, 16, 32, 64, 128])
+def test_jobs_stay_within_the_budget(total_gib, threads):
+    jobs = compile_jobs(total_gib * 1024 * 1024, threads)
+    make_conf = MakeConf()
+    make_conf.tune(threads, jobs, [])
+    assert make_conf.jobs * make_conf.emerge_jobs <= jobs
+    if jobs < threads:
+        # Memory bound, one package may need every job
+        assert make_conf.emerge_jobs == 1
+        assert make_conf.jobs == jobs
+
+
+def test_write_replaces_the_file(tmp_path):
+    make_conf = MakeConf()
+    (tmp_path / "etc/portage").mkdir(parents=True)
+    (tmp_path / "etc/portage/make.conf").write_text("old\n")
+    make_conf.write(str(tmp_path))
+    assert (tmp_path / "etc/portage/make.conf").read_text() == make_conf.render()
+    assert sorted(path.name for path in (tmp_path / "etc/portage").iterdir()) == [
+        "make.conf"
+    ]
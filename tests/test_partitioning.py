@@ -0,0 +1,83 @@
+"""
+Tests for the sfdisk scripts made from storage.partitions.
+"""
+import json
+import shutil
+import subprocess
+
+import pytest
+
+from gentooinstall.lib import parttable
+from gentooinstall.lib.partitioning import plan_layout, sfdisk_script
+
+from .test_parttable import BIOS_PARTITIONS, IMAGE_SIZE, PARTITIONS
+
+ESP = "C12A7328-F81F-11D2-BA4B-00A0C93EC93B"
+SWAP = "0657FD6D-A4AB-43C4-84E5-0933C84B4F4F"
+LINUX = "0FC63DAF-8483-4772-8E79-3D69E4477DE4"
+
+
+def test_gpt_script():
+    assert sfdisk_script(plan_layout(PARTITIONS, True), "gpt") == (
+        "label: gpt\n"
+        "\n"
+        f"start=2048, size=524288, type={ESP}\n"
+        f"start=526336, size=2097152, type={SWAP}\n"
+        f"start=2623488, type={LINUX}\n"
+    )
+
+
+def test_dos_script():
+    assert sfdisk_script(plan_layout(BIOS_PARTITIONS, False), "dos") == (
+        "label: dos\n"
+        "\n"
+        "start=2048, size=524288, type=83, bootable\n"
+        "start=526336, size=2097152, type=82\n"
+        "start=2623488, type=83\n"
+    )
+
+
+def test_script_counts_in_sectors():
+    script = sfdisk_script(plan_layout(PARTITIONS, True, 4096), "gpt")
+    assert script.splitlines()[2:] == [
+        f"start=256, size=65536, type={ESP}",
+        f"start=65792, size=262144, type={SWAP}",
+        f"start=327936, type={LINUX}",
+    ]
+
+
+def read_table(path):
+    return json.loads(
+        subprocess.run(
+            ["sfdisk", "--json", path], check=True, capture_output=True, text=True
+        ).stdout
+    )["partitiontable"]
+
+
+@pytest.mark.skipif(shutil.which("sfdisk") is None, reason="sfdisk isn't installed")
+@pytest.mark.parametrize(
+    "partitions, uefi", [(PARTITIONS, True), (BIOS_PARTITIONS, False)]
+)
+def test_sfdisk_and_parttable_agree(tmp_path, partitions, uefi):
+    label = "gpt" if uefi else "dos"
+    layout = plan_layout(partitions, uefi)
+    scripted, written = str(tmp_path / "scripted.img"), str(tmp_path / "written.img")
+    with open(scripted, "wb") as file:
+        file.truncate(IMAGE_SIZE)
+    subprocess.run(
+        ["sfdisk", scripted],
+        input=sfdisk_script(layout, label),
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    parttable.write_table(written, layout, label, size=IMAGE_SIZE)
+
+    fields = ("start", "size", "type", "bootable")
+    assert [
+        {key: entry.get(key) for key in fields}
+        for entry in read_table(scripted)["partitions"]
+    ] == [
+        {key: entry.get(key) for key in fields}
+        for entry in read_table(written)["partitions"]
+    ]
@@ -0,0 +1,113 @@
+"""
+Tests for the partition tables written by parttable.
+"""
+import json
+import shutil
+import subprocess
+import uuid
+import zlib
+
+import pytest
+
+from gentooinstall.lib import parttable
+from gentooinstall.lib.partitioning import plan_layout
+
+PARTITIONS = [
+    {"type": "vfat", "size": "256M", "mountpoint": "/boot/efi"},
+    {"type": "swap", "size": "1G", "mountpoint": "swap"},
+    {"type": "ext4", "size": "full", "mountpoint": "/"},
+]
+BIOS_PARTITIONS = [
+    {"type": "ext4", "size": "256M", "mountpoint": "/boot"},
+    {"type": "swap", "size": "1G", "mountpoint": "swap"},
+    {"type": "ext4", "size": "full", "mountpoint": "/"},
+]
+IMAGE_SIZE = 4 * 1024 ** 3
+
+
+def write_image(tmp_path, partitions, uefi):
+    path = str(tmp_path / "disk.img")
+    layout = plan_layout(partitions, uefi)
+    parttable.write_table(path, layout, "gpt" if uefi else "dos", size=IMAGE_SIZE)
+    return path, layout
+
+
+def test_gpt_headers_and_entries(tmp_path):
+    path, layout = write_image(tmp_path, PARTITIONS, True)
+    sectors = IMAGE_SIZE // 512
+    with open(path, "rb") as file:
+        image = file.read(34 * 512)
+        file.seek((sectors - 33) * 512)
+        backup = file.read(33 * 512)
+
+    assert image[510:512] == b"\x55\xaa"
+    for header, entries, current in (
+        (image[512:1024], image[1024 : 1024 + 16384], 1),
+        (backup[-512:], backup[:16384], sectors - 1),
+    ):
+        fields = list(parttable.GPT_HEADER.unpack(header[: parttable.GPT_HEADER.size]))
+        assert fields[0] == b"EFI PART"
+        assert fields[5] == current
+        assert fields[13] == zlib.crc32(entries)
+        crc, fields[3] = fields[3], 0
+        assert crc == zlib.crc32(parttable.GPT_HEADER.pack(*fields))
+
+    last_usable = sectors - 34
+    for index, extent in enumerate(layout):
+        kind, _, first, last, _, _ = parttable.GPT_ENTRY.unpack_from(
+            image, 1024 + index * parttable.GPT_ENTRY_SIZE
+        )
+        assert str(uuid.UUID(bytes_le=kind)).upper() == parttable.GPT_TYPES[extent.kind]
+        assert first == extent.start
+        assert last == (
+            last_usable if extent.size is None else extent.start + extent.size - 1
+        )
+
+
+def test_dos_entries(tmp_path):
+    path, layout = write_image(tmp_path, BIOS_PARTITIONS, False)
+    with open(path, "rb") as file:
+        mbr = file.read(512)
+
+    assert mbr[510:512] == b"\x55\xaa"
+    for index, extent in enumerate(layout):
+        flag, _, kind, _, start, size = parttable.MBR_ENTRY.unpack_from(
+            mbr, 446 + index * parttable.MBR_ENTRY.size
+        )
+        assert flag == (0x80 if extent.bootable else 0)
+        assert kind == int(parttable.DOS_TYPES[extent.kind], 16)
+        assert start == extent.start
+        assert size == (
+            IMAGE_SIZE // 512 - start if extent.size is None else extent.size
+        )
+
+
+@pytest.mark.skipif(shutil.which("sfdisk") is None, reason="sfdisk isn't installed")
+@pytest.mark.parametrize(
+    "partitions, uefi", [(PARTITIONS, True), (BIOS_PARTITIONS, False)]
+)
+def test_sfdisk_reads_back_the_table(tmp_path, partitions, uefi):
+    path, layout = write_image(tmp_path, partitions, uefi)
+    dump = json.loads(
+        subprocess.run(
+            ["sfdisk", "--json", path], check=True, capture_output=True, text=True
+        ).stdout
+    )["partitiontable"]
+
+    assert dump["label"] == ("gpt" if uefi else "dos")
+    types = parttable.GPT_TYPES if uefi else parttable.DOS_TYPES
+    assert len(dump["partitions"]) == len(layout)
+    for entry, extent in zip(dump["partitions"], layout):
+        assert entry["start"] == extent.start
+        if extent.size is not None:
+            assert entry["size"] == extent.size
+        assert entry["type"].upper() == types[extent.kind].upper()
+        assert bool(entry.get("bootable")) == extent.bootable
+
+
+def test_partitions_must_fit(tmp_path):
+    layout = [parttable.Extent(2048, IMAGE_SIZE // 512, "linux", False)]
+    with pytest.raises(ValueError):
+        parttable.write_table(
+            str(tmp_path / "disk.img"), layout, "gpt", size=IMAGE_SIZE
+        )
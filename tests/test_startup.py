@@ -0,0 +1,65 @@
+"""
+Startup budget: --help mustn't pay for loading the installer.
+"""
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent
+# Only needed once the install runs
+HEAVY_MODULES = (
+    "requests",
+    "urllib3",
+    "rich",
+    "bs4",
+    "gentooinstall.lib.installer",
+)
+# Modules --help may import on top of a bare interpreter, and the time they may take
+MODULE_BUDGET = 20
+TIME_BUDGET = 0.1
+
+
+def import_times(*args: str) -> dict:
+    """
+    Returns the modules imported by python -X importtime args,
+    with the seconds each took to import (not counting what it imported).
+    """
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", *args],
+        cwd=ROOT,
+        env={**os.environ, "PYTHONPATH": str(ROOT)},
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    modules = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_time, _, name = line.removeprefix("import time:").split("|")
+        # The header line has no numbers in it
+        if self_time.strip().isdigit():
+            modules[name.strip()] = int(self_time) / 1_000_000
+    return modules
+
+
+def test_help_skips_heavy_modules():
+    modules = import_times("-m", "gentooinstall", "--help")
+    heavy = [
+        name
+        for name in modules
+        if any(name == top or name.startswith(f"{top}.") for top in HEAVY_MODULES)
+    ]
+    assert not heavy
+
+
+def test_help_startup_budget():
+    bare = import_times("-c", "pass")
+    extra = {
+        name: seconds
+        for name, seconds in import_times("-m", "gentooinstall", "--help").items()
+        if name not in bare
+    }
+    assert len(extra) <= MODULE_BUDGET, sorted(extra)
+    assert sum(extra.values()) <= TIME_BUDGET, sorted(extra.items())